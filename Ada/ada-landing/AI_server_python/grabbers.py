@@ -4,7 +4,10 @@ from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup
 from urllib.parse import urlparse, unquote, urljoin
 import re
+import os
 import logging
+import concurrent.futures
+import itertools
 
 # Configure logger for this module
 logger = logging.getLogger(__name__)
@@ -19,12 +22,8 @@ except ImportError:
     logger.warning("ddgs not installed, falling back to HTML scraping")
 
 
-def create_session():
-    """Create a requests session with connection pooling and retry logic.
-    
-    Creates a new session per function call (thread-safe) while still
-    benefiting from connection reuse within that call.
-    """
+def create_session(pool_connections=5, pool_maxsize=5):
+    """Create a requests session with connection pooling and retry logic."""
     session = requests.Session()
     
     # Configure retry strategy - reduced from 3 to 2 retries
@@ -34,11 +33,10 @@ def create_session():
         status_forcelist=[429, 500, 502, 503, 504],
     )
     
-    # Mount adapter with reduced connection pooling
     adapter = HTTPAdapter(
         max_retries=retry_strategy,
-        pool_connections=5,
-        pool_maxsize=5
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize
     )
     session.mount("http://", adapter)
     session.mount("https://", adapter)
@@ -46,6 +44,24 @@ def create_session():
     return session
 
 
+# Browser-like headers sent with every scrape request
+SCRAPE_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
+# One process-wide session shared by every search thread so keep-alive connections
+# (and their TLS handshakes) are reused across queries. The session itself is never
+# mutated after creation; per-request headers are passed explicitly.
+_shared_session = create_session(pool_connections=64, pool_maxsize=128)
+
+# Pages of one query are fetched in parallel on this shared, bounded pool. It is separate
+# from the caller's per-query pool, so a query waiting on its pages never starves them.
+_PAGE_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.getenv('SCRAPE_WORKERS', '32')),
+    thread_name_prefix='scrape'
+)
+
+
 def extract_domain(url):
     """Extract domain name from URL for display."""
     try:
@@ -145,6 +161,24 @@ def extract_main_content(soup):
     return ' '.join(text.split())[:8000]
 
 
+# Valid image extensions (case insensitive)
+_IMAGE_EXT_RE = re.compile(r'\.(jpg|jpeg|png|webp|gif|bmp|avif)(\?.*)?$', re.IGNORECASE)
+
+# Patterns to skip (icons, logos, social media, etc.)
+_IMAGE_SKIP_PATTERNS = [
+    r'favicon', r'logo[-_]', r'[-_]logo', r'[-_]icon', r'icon[-_]',
+    r'sprite', r'avatar',
+    r'facebook', r'twitter', r'linkedin', r'instagram', r'pinterest',
+    r'youtube', r'tiktok', r'whatsapp', r'telegram', r'reddit',
+    r'share[-_]', r'[-_]share', r'social', r'button', r'badge', r'emoji',
+    r'loading', r'spinner', r'placeholder', r'blank',
+    r'pixel', r'tracking', r'analytics', r'banner[-_]?ad',
+    r'1x1', r'spacer', r'transparent\.', r'arrow[-_]', r'chevron',
+    r'close[-_]', r'[-_]close', r'menu[-_]', r'hamburger',
+]
+_IMAGE_SKIP_RE = re.compile('|'.join(_IMAGE_SKIP_PATTERNS), re.IGNORECASE)
+
+
 def extract_images(soup, page_url, max_images=5):
     """
     Extract relevant images from a page with smart filtering.
@@ -169,22 +203,6 @@ def extract_images(soup, page_url, max_images=5):
     images = []
     seen_urls = set()
     
-    # Valid image extensions (case insensitive)
-    valid_extensions = re.compile(r'\.(jpg|jpeg|png|webp|gif|bmp|avif)(\?.*)?$', re.IGNORECASE)
-    
-    # Patterns to skip (icons, logos, social media, etc.)
-    skip_patterns = [
-        r'favicon', r'logo[-_]', r'[-_]logo', r'[-_]icon', r'icon[-_]',
-        r'sprite', r'avatar',
-        r'facebook', r'twitter', r'linkedin', r'instagram', r'pinterest',
-        r'youtube', r'tiktok', r'whatsapp', r'telegram', r'reddit',
-        r'share[-_]', r'[-_]share', r'social', r'button', r'badge', r'emoji',
-        r'loading', r'spinner', r'placeholder', r'blank',
-        r'pixel', r'tracking', r'analytics', r'banner[-_]?ad',
-        r'1x1', r'spacer', r'transparent\.', r'arrow[-_]', r'chevron',
-        r'close[-_]', r'[-_]close', r'menu[-_]', r'hamburger',
-    ]
-    skip_regex = re.compile('|'.join(skip_patterns), re.IGNORECASE)
     
     # Find all img tags
     for img in soup.find_all('img'):
@@ -220,7 +238,7 @@ def extract_images(soup, page_url, max_images=5):
         
         # Check if URL has a valid image extension OR contains image indicators
         url_lower = src.lower()
-        has_valid_extension = valid_extensions.search(url_lower)
+        has_valid_extension = _IMAGE_EXT_RE.search(url_lower)
         has_image_path = any(x in url_lower for x in ['/image', '/img', '/photo', '/picture', '/media', '/upload'])
         
         # Skip if no valid extension and no image path indicators (likely not an image)
@@ -230,7 +248,7 @@ def extract_images(soup, page_url, max_images=5):
                 continue
         
         # Skip if URL matches skip patterns
-        if skip_regex.search(src):
+        if _IMAGE_SKIP_RE.search(src):
             continue
         
         # Check for small dimensions in attributes
@@ -247,14 +265,14 @@ def extract_images(soup, page_url, max_images=5):
         # Check class/id for skip patterns
         img_class = ' '.join(img.get('class', []))
         img_id = img.get('id', '')
-        if skip_regex.search(img_class) or skip_regex.search(img_id):
+        if _IMAGE_SKIP_RE.search(img_class) or _IMAGE_SKIP_RE.search(img_id):
             continue
         
         # Get alt text
         alt = img.get('alt', '').strip()
         
         # Skip if alt text indicates it's an icon/logo
-        if alt and skip_regex.search(alt):
+        if alt and _IMAGE_SKIP_RE.search(alt):
             continue
         
         # Add to results
@@ -292,7 +310,7 @@ def search_html_fallback(query, num_results, session):
     """
     try:
         search_url = f"https://html.duckduckgo.com/html/?q={requests.utils.quote(query)}"
-        response = session.get(search_url, timeout=8)
+        response = session.get(search_url, headers=SCRAPE_HEADERS, timeout=8)
         soup = BeautifulSoup(response.text, 'html.parser')
         
         links = []
@@ -316,13 +334,63 @@ def search_html_fallback(query, num_results, session):
         return [], False
 
 
-def search_and_scrape(search, result_number):
+def scrape_page(url, cancel_event=None):
+    """
+    Fetch one page and extract its title, main text and images.
+    
+    Returns:
+    tuple: (source dict, result dict, images list) - a failed fetch still yields a source,
+    or None if cancel_event was set before the fetch started
+    """
+    if cancel_event is not None and cancel_event.is_set():
+        return None
+    logger.debug("Scraping %s...", url[:50])
+    try:
+        page_response = _shared_session.get(url, headers=SCRAPE_HEADERS, timeout=10, allow_redirects=True)
+        page_response.raise_for_status()
+        page_soup = BeautifulSoup(page_response.content, 'html.parser')
+        
+        # Get page title
+        title_tag = page_soup.find('title')
+        title = title_tag.get_text(strip=True) if title_tag else extract_domain(url)
+        
+        # Truncate long titles
+        if len(title) > 80:
+            title = title[:77] + '...'
+        
+        # Use smart content extraction - gets clean content, removes junk
+        text = extract_main_content(page_soup)
+        
+        # Extract images from the page (before decomposing soup)
+        page_images = extract_images(page_soup, url, max_images=5)
+        
+        # Free memory immediately after processing each page
+        page_soup.decompose()
+        del page_soup, page_response
+        
+        return (
+            {'url': url, 'title': title, 'domain': extract_domain(url)},
+            {'url': url, 'title': title, 'text': text},
+            page_images,
+        )
+    except Exception as e:
+        logger.warning(f"Error scraping URL: {e}")
+        # Still add the source even if scraping failed
+        return (
+            {'url': url, 'title': extract_domain(url), 'domain': extract_domain(url)},
+            {'url': url, 'title': extract_domain(url), 'text': f'Error scraping: {str(e)}'},
+            [],
+        )
+
+
+def search_and_scrape(search, result_number, cancel_event=None):
     """
     Takes a search query and number of results, returns text data and images from those websites.
     
     Parameters:
     search (str): The search query
     result_number (int): Number of websites to scrape
+    cancel_event (threading.Event): Optional; once set, pages not yet fetched are skipped
     
     Returns:
     dict: Contains 'sources' list, 'full_text' combined content, 'images' list, 'count', and 'service_available'
@@ -336,19 +404,13 @@ def search_and_scrape(search, result_number):
     links = []
     service_available = True
     
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    }
-    
     # Step 1: Get search results using DDGS or fallback
     if USE_DDGS:
         search_results, service_available = search_ddgs(search, result_number)
         links = [r['url'] for r in search_results]
     else:
         # Fallback to HTML scraping (less reliable)
-        with create_session() as session:
-            session.headers.update(headers)
-            links, service_available = search_html_fallback(search, result_number, session)
+        links, service_available = search_html_fallback(search, result_number, _shared_session)
     
     # If search service is unavailable, return early with flag
     if not service_available:
@@ -370,69 +432,24 @@ def search_and_scrape(search, result_number):
             'service_available': True
         }
     
-    logger.debug(f"Found {len(links)} links to scrape")
-    
-    # Step 2: Scrape each website
-    with create_session() as session:
-        session.headers.update(headers)
-        
-        for i, url in enumerate(links[:result_number]):
-            logger.debug(f"Scraping {i+1}/{min(len(links), result_number)}: {url[:50]}...")
-            try:
-                page_response = session.get(url, timeout=10, allow_redirects=True)
-                page_response.raise_for_status()
-                page_soup = BeautifulSoup(page_response.content, 'html.parser')
-                
-                # Get page title
-                title_tag = page_soup.find('title')
-                title = title_tag.get_text(strip=True) if title_tag else extract_domain(url)
-                
-                # Truncate long titles
-                if len(title) > 80:
-                    title = title[:77] + '...'
-                
-                # Use smart content extraction - gets clean content, removes junk
-                text = extract_main_content(page_soup)
-                
-                # Extract images from the page (before decomposing soup)
-                page_images = extract_images(page_soup, url, max_images=5)
-                all_images.extend(page_images)
-                
-                # Add source info
-                sources.append({
-                    'url': url,
-                    'title': title,
-                    'domain': extract_domain(url)
-                })
-                
-                results.append({
-                    'url': url,
-                    'title': title,
-                    'text': text
-                })
-                
-                # Free memory immediately after processing each page
-                page_soup.decompose()
-                del page_soup, page_response
-                
-            except Exception as e:
-                logger.warning(f"Error scraping URL: {e}")
-                # Still add the source even if scraping failed
-                sources.append({
-                    'url': url,
-                    'title': extract_domain(url),
-                    'domain': extract_domain(url)
-                })
-                results.append({
-                    'url': url,
-                    'title': extract_domain(url),
-                    'text': f'Error scraping: {str(e)}'
-                })
+    logger.debug("Found %d links to scrape", len(links))
     
-    # Build full text for AI processing
-    full_text = ""
-    for i, result in enumerate(results, 1):
-        full_text += f"\n\n--- Source {i}: {result.get('title', 'Unknown')} ---\nURL: {result['url']}\n{result['text']}"
+    # Step 2: Scrape the websites concurrently (map keeps the search-result order).
+    # Cancelled pages come back as None without holding a pool slot for the fetch
+    links = links[:result_number]
+    for scraped in _PAGE_POOL.map(scrape_page, links, itertools.repeat(cancel_event, len(links))):
+        if scraped is None:
+            continue
+        source, result, page_images = scraped
+        sources.append(source)
+        results.append(result)
+        all_images.extend(page_images)
+
+    # Build full text for AI processing (join once instead of growing a string)
+    full_text = "".join(
+        f"\n\n--- Source {i}: {result.get('title', 'Unknown')} ---\nURL: {result['url']}\n{result['text']}"
+        for i, result in enumerate(results, 1)
+    )
     
     return {
         'sources': sources,
@@ -1,43 +1,101 @@
 import os
-import json
+import atexit
+import orjson
+import io
 import re
-import gc
 import threading
 import uuid
+import time
 import base64
-import traceback
 import random
 import logging
-from functools import wraps
+import queue
+from logging.handlers import QueueHandler, QueueListener
+import hashlib
+import itertools
+from collections import OrderedDict
+from cachetools import TTLCache
+from functools import wraps, lru_cache
 from flask import Flask, request, Response, stream_with_context, g
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from datetime import date, datetime, timedelta
 from dotenv import load_dotenv
 from openai import OpenAI
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import grabbers
 import concurrent.futures
 import stripe
 import firebase_admin
 from firebase_admin import credentials, firestore, auth as firebase_auth
+from google.api_core import exceptions as gcp_exceptions
+
+# RE2 matches in linear time, so malformed output (e.g. unclosed think tags) can't
+# trigger slow lazy-quantifier scans; stdlib re is used if it isn't installed
+try:
+    import re2 as artifact_re
+except ImportError:
+    artifact_re = re
+
+# tiktoken gives real token counts for input budgets; fall back to a chars-per-token estimate
+try:
+    import tiktoken
+    USE_TIKTOKEN = True
+except ImportError:
+    USE_TIKTOKEN = False
+
+# Redis (installed with flask-limiter[redis]) backs state that every worker must agree on
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Under gevent (wsgi.py) pool "threads" are greenlets, so worker pools can be sized per connection
+try:
+    from gevent import monkey as gevent_monkey
+    GEVENT_PATCHED = gevent_monkey.is_module_patched('threading')
+except ImportError:
+    GEVENT_PATCHED = False
 
 # Configure logging - use INFO in production, DEBUG in development
+# Request threads only enqueue records; a background listener does the actual writes.
+# The QueueHandler applies the format, so the listener's handler just prints the message.
+class _DroppingQueueHandler(QueueHandler):
+    """QueueHandler that drops records instead of erroring when the queue is full."""
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+# Bounded so a stalled stdout can't grow the backlog without limit under a log burst
+_log_queue = queue.Queue(maxsize=10000)
+_log_listener = QueueListener(_log_queue, logging.StreamHandler(), respect_handler_level=True)
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[_DroppingQueueHandler(_log_queue)]
 )
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
 
 # Human-like status message options
-GENERATING_MESSAGES = [
+GENERATING_MESSAGES = (
     "Typing something up",
     "Pressing some buttons",
     "Dusting off my keyboard"
-]
+)
 
-THINKING_MESSAGES = [
+THINKING_MESSAGES = (
     "Taking a drink of water",
     "Eating some chips",
     "Stretching",
@@ -55,25 +113,37 @@ THINKING_MESSAGES = [
     "Leaning back in my chair",
     "Tapping my fingers",
     "Humming a tune",
-    "Daydreaming briefly"
+    "Daydreaming briefly",
     "Eating a burger"
-]
+)
 
-SEARCHING_MESSAGES = [
+SEARCHING_MESSAGES = (
     "Reading search results",
     "Cleaning my glasses",
     "Squinting at the screen"
-]
+)
+
+
+def _shuffled_cycle(messages):
+    shuffled = list(messages)
+    random.shuffle(shuffled)
+    return itertools.cycle(shuffled)
+
+
+# One shuffled cycle per message list, shared by every request in the process, so picking
+# a message is a next() rather than an RNG call and repeats are spread across requests.
+# next() on an itertools.cycle is a single C call, so it is safe without a lock.
+_STATUS_CYCLES = {
+    "generating": _shuffled_cycle(GENERATING_MESSAGES),
+    "searching": _shuffled_cycle(SEARCHING_MESSAGES),
+}
+_THINKING_CYCLE = _shuffled_cycle(THINKING_MESSAGES)
 
 
 def get_status_message(status_type: str) -> str:
     """Get a random status message for the given type."""
-    if status_type == "generating":
-        return random.choice(GENERATING_MESSAGES)
-    elif status_type == "searching":
-        return random.choice(SEARCHING_MESSAGES)
-    else:  # thinking, evaluating, or anything else
-        return random.choice(THINKING_MESSAGES)
+    # thinking, evaluating, or anything else
+    return next(_STATUS_CYCLES.get(status_type, _THINKING_CYCLE))
 
 
 def get_status_with_cycle_options(status_type: str) -> dict:
@@ -89,36 +159,108 @@ def get_status_with_cycle_options(status_type: str) -> dict:
     return result
 
 
-# Thread-safe dict to track skip search requests by session_id
+# Fixed fields of the step-0 "thinking" status sent before any work starts; only the
+# message varies per event
+_INITIAL_THINKING_EVENT = {
+    "type": "status",
+    "step": 0,
+    "icon": "thinking",
+    **get_status_with_cycle_options("thinking"),
+}
+
+
+# Skip search events by session_id. Each session gets its own threading.Event, so
+# request_skip_search only has to set() it and the search loop reads is_set()
+# without taking any lock (single-key dict ops are atomic under the GIL).
 _skip_search_requests = {}
-_skip_search_lock = threading.Lock()
+_session_last_seen = {}  # session_id -> time.monotonic() of last activity
+_NEVER_SKIP = threading.Event()  # Never set; stands in for unknown sessions
+
+# Sessions idle this long are evicted by the sweeper even if cleanup_session never ran.
+# Live streams refresh their entry on every event and skip check, so a long research
+# session keeps its skip event; normal completion is handled by cleanup_session
+SESSION_TTL_SECONDS = 600
+SESSION_SWEEP_INTERVAL = 60
 
 
 def request_skip_search(session_id: str) -> bool:
     """Mark a session as requesting to skip search. Returns True if session was found."""
-    with _skip_search_lock:
-        if session_id in _skip_search_requests:
-            _skip_search_requests[session_id] = True
-            return True
+    skip_event = _skip_search_requests.get(session_id)
+    if skip_event is None:
         return False
+    skip_event.set()
+    return True
 
 
 def check_skip_search(session_id: str) -> bool:
     """Check if a session has requested to skip search."""
-    with _skip_search_lock:
-        return _skip_search_requests.get(session_id, False)
+    touch_session(session_id)
+    return _skip_search_requests.get(session_id, _NEVER_SKIP).is_set()
+
+
+def touch_session(session_id: str):
+    """Mark a session as still active so the sweeper leaves it alone."""
+    # Only refresh live entries - never resurrect one that was already cleaned up
+    if session_id in _session_last_seen:
+        _session_last_seen[session_id] = time.monotonic()
 
 
 def register_session(session_id: str):
     """Register a new session for skip tracking."""
-    with _skip_search_lock:
-        _skip_search_requests[session_id] = False
+    _skip_search_requests[session_id] = threading.Event()
+    _session_last_seen[session_id] = time.monotonic()
 
 
 def cleanup_session(session_id: str):
     """Clean up session from skip tracking."""
-    with _skip_search_lock:
-        _skip_search_requests.pop(session_id, None)
+    _skip_search_requests.pop(session_id, None)
+    _session_last_seen.pop(session_id, None)
+
+
+def _sweep_stale_sessions():
+    """Periodically evict sessions whose stream never reached cleanup_session."""
+    while True:
+        time.sleep(SESSION_SWEEP_INTERVAL)
+        cutoff = time.monotonic() - SESSION_TTL_SECONDS
+        for session_id, last_seen in list(_session_last_seen.items()):
+            if last_seen < cutoff:
+                cleanup_session(session_id)
+
+
+threading.Thread(target=_sweep_stale_sessions, name='session-sweeper', daemon=True).start()
+
+
+def result_unless_skipped(future, session_id: str, poll_interval: float = 0.2):
+    """Wait for a future's result, giving up early if the session requests a skip.
+    
+    Returns None when skipped. The abandoned call is cancelled if it hasn't
+    started yet; otherwise it finishes in the background and is discarded.
+    """
+    skip_event = _skip_search_requests.get(session_id) if session_id else None
+    if skip_event is None:
+        return future.result()
+    
+    while not skip_event.is_set():
+        done, _ = concurrent.futures.wait([future], timeout=poll_interval)
+        if done:
+            return future.result()
+        touch_session(session_id)
+    
+    future.cancel()
+    return None
+
+
+# Substrings (lowercase) that every artifact pattern in clean_ai_output starts with
+_AI_ARTIFACT_MARKERS = ('<think', '</think', '<|', '<｜')
+_BLANK_LINES_RE = re.compile(r'\n\s*\n')
+_THINK_BLOCK_RE = artifact_re.compile(r'(?is)<think>.*?</think>')
+_THINKING_BLOCK_RE = artifact_re.compile(r'(?is)<thinking>.*?</thinking>')
+_LEADING_THINK_RE = artifact_re.compile(r'(?is)^.*?</think>')
+_LEADING_THINKING_RE = artifact_re.compile(r'(?is)^.*?</thinking>')
+_SPECIAL_TOKEN_RE = artifact_re.compile(r'<\|.*?\|>')
+
+# Per-query source depth suffix in generated search queries, e.g. "nvidia stock depth3"
+_DEPTH_RE = re.compile(r'depth\s*(\d+)', re.IGNORECASE)
 
 
 def clean_ai_output(text):
@@ -126,24 +268,36 @@ def clean_ai_output(text):
     if not text:
         return text
     
+    # Fast path: most outputs have no artifacts, so only whitespace needs cleaning.
+    # Every marker starts with '<', so a plain substring check rules most text out
+    # before paying for lower().
+    has_artifacts = '<' in text
+    if has_artifacts:
+        lowered = text.lower()
+        has_artifacts = any(marker in lowered for marker in _AI_ARTIFACT_MARKERS)
+    if not has_artifacts:
+        if '\n' not in text:
+            return text.strip()
+        return _BLANK_LINES_RE.sub('\n', text).strip()
+    
     # Remove <think>...</think> tags and content (Qwen3 thinking format)
-    text = re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL | re.IGNORECASE)
+    text = _THINK_BLOCK_RE.sub('', text)
     
     # Remove <thinking>...</thinking> tags and content
-    text = re.sub(r'<thinking>.*?</thinking>', '', text, flags=re.DOTALL | re.IGNORECASE)
+    text = _THINKING_BLOCK_RE.sub('', text)
     
     # Remove any unclosed thinking tags at the start
-    text = re.sub(r'^.*?</think>', '', text, flags=re.DOTALL | re.IGNORECASE)
-    text = re.sub(r'^.*?</thinking>', '', text, flags=re.DOTALL | re.IGNORECASE)
+    text = _LEADING_THINK_RE.sub('', text)
+    text = _LEADING_THINKING_RE.sub('', text)
     
     # Remove the sentence marker mentioned in prompts
     text = text.replace('<｜begin▁of▁sentence｜>', '')
     
     # Remove any other common AI artifacts
-    text = re.sub(r'<\|.*?\|>', '', text)  # Remove tokens like <|endoftext|>
+    text = _SPECIAL_TOKEN_RE.sub('', text)  # Remove tokens like <|endoftext|>
     
     # Clean up extra whitespace
-    text = re.sub(r'\n\s*\n', '\n', text)
+    text = _BLANK_LINES_RE.sub('\n', text)
     text = text.strip()
     
     return text
@@ -151,16 +305,24 @@ def clean_ai_output(text):
 # Load environment variables
 load_dotenv()
 
-# Stripe configuration - loaded lazily to avoid build-time issues
-_stripe_initialized = False
-
+# Keep-alive session for Stripe API calls so checkout/cancel/webhook requests skip the TLS handshake
+_stripe_session = requests.Session()
+_stripe_session.mount("https://", HTTPAdapter(
+    pool_connections=64,
+    pool_maxsize=128,
+    max_retries=Retry(total=2, backoff_factor=0.1),
+))
+# stripe>=8 exports RequestsClient at the top level; older releases only under stripe.http_client
+_StripeRequestsClient = getattr(stripe, 'RequestsClient', None) or stripe.http_client.RequestsClient
+
+# Stripe configuration - loaded lazily (first call) to avoid build-time issues, then cached.
+# Callers must treat the returned dict as read-only.
+@lru_cache(maxsize=1)
 def get_stripe_config():
     """Get Stripe configuration, initializing if needed."""
-    global _stripe_initialized
-    if not _stripe_initialized:
-        # Use STRIPE_API_KEY to avoid Railway's secret detection on "SECRET" pattern
-        stripe.api_key = os.getenv('STRIPE_API_KEY')
-        _stripe_initialized = True
+    # Use STRIPE_API_KEY to avoid Railway's secret detection on "SECRET" pattern
+    stripe.api_key = os.getenv('STRIPE_API_KEY')
+    stripe.default_http_client = _StripeRequestsClient(session=_stripe_session, timeout=30)
     return {
         # Use STRIPE_WEBHOOK_KEY to avoid Railway's secret detection
         'webhook_secret': os.getenv('STRIPE_WEBHOOK_KEY'),
@@ -168,6 +330,10 @@ def get_stripe_config():
         'frontend_url': os.getenv('FRONTEND_URL', 'http://localhost:3000')
     }
 
+# Short-lived cache of Firebase user ID -> Stripe customer ID for repeat checkout clicks
+_customer_cache = TTLCache(maxsize=10000, ttl=60)
+_customer_cache_lock = threading.Lock()
+
 # Initialize Firebase Admin SDK
 _firebase_initialized = False
 _firestore_db = None
@@ -184,13 +350,12 @@ def get_firestore_db():
     
     if firebase_service_account:
         try:
-            # Check if it's base64 encoded
-            try:
-                decoded = base64.b64decode(firebase_service_account)
-                service_account_info = json.loads(decoded)
-            except (ValueError, json.JSONDecodeError):
-                # Assume it's raw JSON
-                service_account_info = json.loads(firebase_service_account)
+            # Raw JSON starts with '{'; anything else is treated as base64 encoded
+            raw_account = firebase_service_account.strip()
+            if raw_account.startswith('{'):
+                service_account_info = orjson.loads(raw_account)
+            else:
+                service_account_info = orjson.loads(base64.b64decode(raw_account))
             
             cred = credentials.Certificate(service_account_info)
             firebase_admin.initialize_app(cred)
@@ -219,6 +384,27 @@ def ensure_firebase_initialized():
         # This will initialize Firebase if not already done
         get_firestore_db()
 
+# Verified Firebase ID tokens keyed by a digest of the raw token. Entries also carry the
+# token's exp claim, so a cached token is never accepted past its own expiry.
+_verified_token_cache = TTLCache(maxsize=10000, ttl=300)
+_verified_token_lock = threading.Lock()
+TOKEN_EXPIRY_MARGIN_SECONDS = 30
+
+
+def verify_id_token_cached(token: str) -> dict:
+    """verify_id_token with a short-lived cache; raises the same errors on a miss."""
+    key = hashlib.blake2b(token.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+    with _verified_token_lock:
+        cached = _verified_token_cache.get(key)
+    if cached is not None and time.time() < cached['exp'] - TOKEN_EXPIRY_MARGIN_SECONDS:
+        return cached
+    
+    decoded_token = firebase_auth.verify_id_token(token)
+    with _verified_token_lock:
+        _verified_token_cache[key] = decoded_token
+    return decoded_token
+
+
 def require_auth(f):
     """Decorator that verifies Firebase ID tokens for authenticated endpoints.
     
@@ -235,47 +421,47 @@ def require_auth(f):
         if not auth_header.startswith('Bearer '):
             logger.warning("Auth failed: Missing or invalid Authorization header")
             return Response(
-                json.dumps({"error": "Missing or invalid authentication token"}),
+                orjson.dumps({"error": "Missing or invalid authentication token"}),
                 status=401,
                 mimetype='application/json'
             )
         
-        token = auth_header.split('Bearer ')[1]
+        token = auth_header[len('Bearer '):]
         
         # Check if Firebase was successfully initialized
         if not _firebase_initialized or not firebase_admin._apps:
             logger.error("Auth failed: Firebase Admin SDK not initialized")
             return Response(
-                json.dumps({"error": "Authentication service unavailable"}),
+                orjson.dumps({"error": "Authentication service unavailable"}),
                 status=503,
                 mimetype='application/json'
             )
         
         try:
-            # Verify the Firebase ID token
-            decoded_token = firebase_auth.verify_id_token(token)
+            # Verify the Firebase ID token (repeat callers hit the cache and skip the RSA check)
+            decoded_token = verify_id_token_cached(token)
             # Attach the verified user ID to flask.g for use in the endpoint
             g.uid = decoded_token['uid']
             g.email = decoded_token.get('email', '')
-            logger.debug(f"Auth successful for user {g.uid[:8]}...")
+            logger.debug("Auth successful for user %s...", g.uid[:8])
         except firebase_auth.InvalidIdTokenError as e:
-            logger.warning(f"Auth failed: Invalid token - {e}")
+            logger.warning("Auth failed: Invalid token - %s", e)
             return Response(
-                json.dumps({"error": "Invalid authentication token"}),
+                orjson.dumps({"error": "Invalid authentication token"}),
                 status=401,
                 mimetype='application/json'
             )
         except firebase_auth.ExpiredIdTokenError:
             logger.warning("Auth failed: Token expired")
             return Response(
-                json.dumps({"error": "Authentication token expired"}),
+                orjson.dumps({"error": "Authentication token expired"}),
                 status=401,
                 mimetype='application/json'
             )
         except Exception as e:
-            logger.error(f"Auth token verification failed: {type(e).__name__}: {e}")
+            logger.error("Auth token verification failed: %s: %s", type(e).__name__, e)
             return Response(
-                json.dumps({"error": "Authentication failed"}),
+                orjson.dumps({"error": "Authentication failed"}),
                 status=401,
                 mimetype='application/json'
             )
@@ -288,6 +474,107 @@ def require_auth(f):
 # CREDIT VERIFICATION (Server-side)
 # =============================================================================
 
+@lru_cache(maxsize=4096)
+def _user_ref(db, user_id: str):
+    """Reusable DocumentReference for users/{user_id} (references are immutable and thread-safe)."""
+    return db.collection('users').document(user_id)
+
+
+# Users who just ran out of credits -> "day|remaining". Rejected retries within the TTL
+# skip the Firestore transaction; a purchase or renewal deletes the entry. It lives in
+# Redis so a webhook handled by one worker clears it for all of them - a per-process
+# cache would keep rejecting a paying user on the other workers. Without Redis there is
+# no negative cache and every request goes to Firestore.
+EXHAUSTED_CREDITS_TTL_SECONDS = 30
+_credits_redis_uri = os.getenv('CREDITS_CACHE_REDIS_URI') or os.getenv('LIMITER_STORAGE_URI', '')
+if redis is not None and _credits_redis_uri.startswith(('redis://', 'rediss://')):
+    _credits_redis = redis.Redis.from_url(_credits_redis_uri, socket_timeout=0.5, socket_connect_timeout=0.5)
+else:
+    _credits_redis = None
+
+
+def _exhausted_credits_key(user_id: str) -> str:
+    return f"credits:exhausted:{user_id}"
+
+
+def get_exhausted_credits(user_id: str):
+    """Cached (day, remaining) for a user who recently ran out of credits, or None."""
+    if _credits_redis is None:
+        return None
+    try:
+        raw = _credits_redis.get(_exhausted_credits_key(user_id))
+    except redis.RedisError as e:
+        logger.debug(f"Exhausted-credits lookup failed: {e}")
+        return None
+    if raw is None:
+        return None
+    day, _, remaining = raw.decode().partition('|')
+    return day, int(remaining)
+
+
+def remember_exhausted_credits(user_id: str, day: str, remaining: int):
+    """Record that a user ran out of credits so retries skip the Firestore transaction."""
+    if _credits_redis is None:
+        return
+    try:
+        _credits_redis.setex(_exhausted_credits_key(user_id), EXHAUSTED_CREDITS_TTL_SECONDS, f"{day}|{remaining}")
+    except redis.RedisError as e:
+        logger.debug(f"Exhausted-credits store failed: {e}")
+
+
+def forget_exhausted_credits(user_id: str):
+    """Drop a user's cached out-of-credits state after their credits were topped up."""
+    if _credits_redis is None:
+        return
+    try:
+        _credits_redis.delete(_exhausted_credits_key(user_id))
+    except redis.RedisError as e:
+        # The entry still expires on its own within EXHAUSTED_CREDITS_TTL_SECONDS
+        logger.warning(f"Could not clear exhausted-credits entry for {user_id[:8]}...: {e}")
+
+
+@firestore.transactional
+def _deduct_credits(transaction, user_ref, amount: int) -> tuple:
+    """Read, reset-if-new-day and deduct a user's credits as one Firestore transaction.
+    
+    Every path issues at most one write, and the transaction retries on contention
+    so concurrent requests can't both spend the same credits.
+    """
+    user_doc = user_ref.get(transaction=transaction)
+    today = datetime.now().strftime('%Y-%m-%d')
+    
+    if not user_doc.exists:
+        # Initialize new user with default credits
+        current_credits = 20  # FREE_DAILY_CREDITS
+        success = current_credits >= amount
+        remaining = current_credits - amount if success else current_credits
+        transaction.set(user_ref, {'credits': remaining, 'lastCreditReset': today, 'isPremium': False})
+        return success, remaining, None if success else "Insufficient credits"
+    
+    user_data = user_doc.to_dict()
+    current_credits = user_data.get('credits', 0)
+    update = {}
+    
+    # Check for daily reset
+    if user_data.get('lastCreditReset', '') != today:
+        # Reset credits for the new day
+        current_credits = 200 if user_data.get('isPremium', False) else 20
+        update['lastCreditReset'] = today
+    
+    if current_credits < amount:
+        if update:
+            update['credits'] = current_credits
+            transaction.update(user_ref, update)
+        return False, current_credits, "Insufficient credits"
+    
+    # Deduct credits
+    new_credits = current_credits - amount
+    update['credits'] = new_credits
+    transaction.update(user_ref, update)
+    
+    return True, new_credits, None
+
+
 def check_and_deduct_credits(user_id: str, amount: int) -> tuple:
     """Check if user has enough credits and deduct if so.
     
@@ -302,51 +589,34 @@ def check_and_deduct_credits(user_id: str, amount: int) -> tuple:
     if not db:
         return False, 0, "Database unavailable"
     
+    today = datetime.now().strftime('%Y-%m-%d')
+    exhausted = get_exhausted_credits(user_id)
+    if exhausted is not None and exhausted[0] == today and exhausted[1] < amount:
+        return False, exhausted[1], "Insufficient credits"
+    
     try:
-        user_ref = db.collection('users').document(user_id)
-        user_doc = user_ref.get()
-        
-        if not user_doc.exists:
-            # Initialize new user with default credits
-            user_ref.set({
-                'credits': 20,  # FREE_DAILY_CREDITS
-                'lastCreditReset': datetime.now().strftime('%Y-%m-%d'),
-                'isPremium': False,
-            })
-            user_doc = user_ref.get()
-        
-        user_data = user_doc.to_dict()
-        current_credits = user_data.get('credits', 0)
-        
-        # Check for daily reset
-        last_reset = user_data.get('lastCreditReset', '')
-        today = datetime.now().strftime('%Y-%m-%d')
-        
-        if last_reset != today:
-            # Reset credits for the new day
-            is_premium = user_data.get('isPremium', False)
-            daily_limit = 200 if is_premium else 20
-            current_credits = daily_limit
-            user_ref.update({
-                'credits': daily_limit,
-                'lastCreditReset': today
-            })
-        
-        if current_credits < amount:
-            return False, current_credits, "Insufficient credits"
-        
-        # Deduct credits atomically
-        new_credits = current_credits - amount
-        user_ref.update({'credits': new_credits})
-        
-        return True, new_credits, None
-        
+        user_ref = _user_ref(db, user_id)
+        success, remaining, error = _deduct_credits(db.transaction(), user_ref, amount)
+        if not success:
+            remember_exhausted_credits(user_id, today, remaining)
+        return success, remaining, error
     except Exception as e:
         logger.error(f"Credit check failed for user {user_id[:8]}...: {e}")
         return False, 0, "Credit verification failed"
 
 
+class OrjsonProvider(JSONProvider):
+    """Route Flask's own JSON handling (dict returns, request.get_json) through orjson."""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # =============================================================================
 # CORS CONFIGURATION - Restrict to allowed origins only
@@ -362,6 +632,9 @@ _allowed_origins = [
 if os.getenv('FLASK_DEBUG', 'false').lower() == 'true':
     _allowed_origins.append("http://localhost:3000")
 
+# Set form for direct membership checks (flask-cors keeps the list)
+_allowed_origins_set = frozenset(_allowed_origins)
+
 CORS(app, resources={r"/api/*": {
     "origins": _allowed_origins,
     "allow_headers": ["Content-Type", "Authorization", "ngrok-skip-browser-warning", "bypass-tunnel-reminder"],
@@ -376,7 +649,9 @@ limiter = Limiter(
     get_remote_address,
     app=app,
     default_limits=["200 per day", "50 per hour"],
-    storage_uri="memory://",
+    # Point at Redis (redis://...) in production so every gunicorn worker shares one
+    # set of counters; per-process memory multiplies the effective limit by the worker count
+    storage_uri=os.getenv('LIMITER_STORAGE_URI', 'memory://'),
 )
 
 # =============================================================================
@@ -396,38 +671,45 @@ else:
 # SECURITY HEADERS
 # =============================================================================
 
+_SECURITY_HEADERS = (
+    ('X-Content-Type-Options', 'nosniff'),
+    ('X-Frame-Options', 'DENY'),
+    ('X-XSS-Protection', '1; mode=block'),
+    ('Referrer-Policy', 'strict-origin-when-cross-origin'),
+)
+
+
 @app.after_request
 def add_security_headers(response):
     """Add security headers to all responses."""
-    response.headers['X-Content-Type-Options'] = 'nosniff'
-    response.headers['X-Frame-Options'] = 'DENY'
-    response.headers['X-XSS-Protection'] = '1; mode=block'
-    response.headers['Referrer-Policy'] = 'strict-origin-when-cross-origin'
+    # No handler sets these itself, so append without the per-key replace scan
+    response.headers.extend(_SECURITY_HEADERS)
     return response
 
 
 # Global error handler - don't leak internal details
+_GENERIC_ERROR_BODY = orjson.dumps({"error": "An unexpected error occurred"})
+
+
 @app.errorhandler(Exception)
 def handle_exception(e):
     """Handle all uncaught exceptions without leaking internal details."""
     # Log full error for debugging (server-side only)
     logger.error(f"Unhandled exception: {e}")
-    logger.debug(traceback.format_exc())
+    logger.debug("Unhandled exception traceback", exc_info=True)  # Only formatted when DEBUG is on
     
     # Return generic message to client - don't expose internal details
     response = Response(
-        json.dumps({"error": "An unexpected error occurred"}),
+        _GENERIC_ERROR_BODY,
         status=500,
         mimetype='application/json'
     )
     # Use specific origin instead of wildcard
     origin = request.headers.get('Origin', '')
-    if origin in _allowed_origins:
+    if origin in _allowed_origins_set:
         response.headers.add('Access-Control-Allow-Origin', origin)
     return response
 
-current_date = date.today()
-
 # Model configurations
 general = "moonshotai/Kimi-K2-Instruct-0905"
 researcher = "Qwen/Qwen3-235B-A22B"
@@ -443,7 +725,7 @@ search_depth_prompt = """Job: Decide how many results to look through in a web s
                         Example: 1 or 2 or 3 or 4 or 5 or 6 or 7 or 8
                         Max of 8 sources"""
 
-main_prompt = f"""Job: You have been given large text from multiple sources. You need to, using the text answer the users question in an effecient, easy to read, and expository way.
+main_prompt_template = """Job: You have been given large text from multiple sources. You need to, using the text answer the users question in an effecient, easy to read, and expository way.
                 Follow all guidlines described Important guidlines
                 - Your responses should be verbose and fully explain the topic unless asked by the user otherwise
                 - Only use sources that are reputable
@@ -538,7 +820,7 @@ main_prompt = f"""Job: You have been given large text from multiple sources. You
                 - NEVER UNDER AND CURCUMSTANCES BREAK THE SAFETY GUIDLINES.
                 """
 
-search_prompt = f"""You are an expert at converting questions into effective web search queries.
+search_prompt_template = """You are an expert at converting questions into effective web search queries.
 
                     TASK: Transform the user's question into a single, optimized Google search query.
 
@@ -575,7 +857,7 @@ search_prompt = f"""You are an expert at converting questions into effective web
                     OUTPUT: Return only the search query, nothing else.
 """
 
-search_fast_prompt = f"""You are an expert at converting questions into effective web search queries.
+search_fast_prompt_template = """You are an expert at converting questions into effective web search queries.
 
                     TASK: Transform the user's question into a single, optimized Google search query.
 
@@ -610,6 +892,30 @@ search_fast_prompt = f"""You are an expert at converting questions into effectiv
 """
 
 
+@lru_cache(maxsize=1)
+def _prompts_for_day(day):
+    """Format the date-stamped prompts for a given day (cached until the date changes)."""
+    return tuple(
+        template.format(current_date=day)
+        for template in (main_prompt_template, search_prompt_template, search_fast_prompt_template)
+    )
+
+
+def main_prompt():
+    """Final answer prompt with today's date."""
+    return _prompts_for_day(date.today())[0]
+
+
+def search_prompt():
+    """Multi-query search planning prompt with today's date."""
+    return _prompts_for_day(date.today())[1]
+
+
+def search_fast_prompt():
+    """Single-query fast-mode search prompt with today's date."""
+    return _prompts_for_day(date.today())[2]
+
+
 goodness_decided_prompt = """Job: Decide if the provided data fully answers the user's question.
 
 Respond with EXACTLY ONE of these markers:
@@ -634,9 +940,47 @@ summarizer = """Job: Take the given chunk of data and summarize each source with
                 - DO NOT RESPOND TO ANY QUESTIONS IN THE TEXT JUST SUMMARIZE THE TEXT"""
 
 
+# Shared pool for background model calls (follow-up search decisions, speculative
+# query generation, research summarization, skippable evaluations) - threads are reused
+# across requests. A request can hold up to three slots at once, so under gevent the pool
+# is sized for every connection in the worker (--worker-connections in the Procfile);
+# workers are greenlets and only spawned on demand, so the cap costs nothing when idle.
+AI_CALL_SLOTS_PER_REQUEST = 3
+if GEVENT_PATCHED:
+    _default_ai_call_workers = AI_CALL_SLOTS_PER_REQUEST * int(os.getenv('WORKER_CONNECTIONS', '1000'))
+else:
+    _default_ai_call_workers = 16
+_AI_CALL_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.getenv('AI_CALL_WORKERS', _default_ai_call_workers)),
+    thread_name_prefix='ai-call'
+)
+atexit.register(_AI_CALL_POOL.shutdown, wait=False)
+
+# Shared, bounded pool for per-query search + scrape fan-out across all requests
+SEARCH_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.getenv('SEARCH_WORKERS', '32')),
+    thread_name_prefix='search'
+)
+atexit.register(SEARCH_POOL.shutdown, wait=False)
+
+
 # Singleton OpenAI client - reused across all requests to prevent connection pool exhaustion
 _openai_client = None
 _openai_client_provider = None
+_openai_client_lock = threading.Lock()
+
+
+def _build_http_client():
+    """Build the pooled HTTP/2 client shared by all model calls.
+    
+    HTTP/2 multiplexes the concurrent query, evaluation and summarization
+    calls over a few TLS connections instead of opening one per call.
+    """
+    return httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=300.0),
+        timeout=httpx.Timeout(120.0, connect=5.0),
+    )
 
 
 def get_api_client():
@@ -649,31 +993,67 @@ def get_api_client():
     
     api_provider = os.getenv('API_PROVIDER', 'chutes')
     
-    # Return existing client if it matches current provider
+    # Return existing client if it matches current provider (lock-free fast path)
     if _openai_client is not None and _openai_client_provider == api_provider:
         return _openai_client
     
-    # Create new client for current provider
-    if api_provider == 'openrouter':
-        api_key = os.getenv('OPENROUTER_API_KEY')
-        if not api_key:
-            raise ValueError("OPENROUTER_API_KEY environment variable is required")
-        _openai_client = OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=api_key,
-            default_headers={"HTTP-Referer": os.getenv('FRONTEND_URL', 'http://localhost:3000')}
-        )
-    else:  # chutes
-        api_key = os.getenv('CHUTES_API_KEY')
-        if not api_key:
-            raise ValueError("CHUTES_API_KEY environment variable is required")
-        _openai_client = OpenAI(
-            base_url="https://llm.chutes.ai/v1",
-            api_key=api_key
-        )
-    
-    _openai_client_provider = api_provider
-    return _openai_client
+    with _openai_client_lock:
+        # Another thread may have built it while we waited for the lock
+        if _openai_client is not None and _openai_client_provider == api_provider:
+            return _openai_client
+        
+        # Create new client for current provider
+        if api_provider == 'openrouter':
+            api_key = os.getenv('OPENROUTER_API_KEY')
+            if not api_key:
+                raise ValueError("OPENROUTER_API_KEY environment variable is required")
+            client = OpenAI(
+                base_url="https://openrouter.ai/api/v1",
+                api_key=api_key,
+                default_headers={"HTTP-Referer": os.getenv('FRONTEND_URL', 'http://localhost:3000')},
+                http_client=_build_http_client()
+            )
+        else:  # chutes
+            api_key = os.getenv('CHUTES_API_KEY')
+            if not api_key:
+                raise ValueError("CHUTES_API_KEY environment variable is required")
+            client = OpenAI(
+                base_url="https://llm.chutes.ai/v1",
+                api_key=api_key,
+                http_client=_build_http_client()
+            )
+        
+        # Publish the client before its provider: a reader that sees the new client with the
+        # old provider just falls through to the lock instead of returning a mismatched client
+        _openai_client = client
+        _openai_client_provider = api_provider
+        return client
+
+
+# API key each provider's client needs; prewarming is skipped when it isn't set
+_PROVIDER_KEY_ENV = {
+    'openrouter': 'OPENROUTER_API_KEY',
+    'chutes': 'CHUTES_API_KEY',
+}
+
+
+def _prewarm_api_client():
+    """Build the API client and open a pooled connection before the first request."""
+    api_provider = os.getenv('API_PROVIDER', 'chutes')
+    key_env = _PROVIDER_KEY_ENV.get(api_provider, 'CHUTES_API_KEY')
+    if not os.getenv(key_env):
+        # Not configured for this deployment - don't open connections to a provider it won't use
+        logger.debug("[Module Load] Skipping API client pre-warm: %s not set for provider %s", key_env, api_provider)
+        return
+    try:
+        get_api_client().models.list()
+        logger.info("[Module Load] API client connection pre-warmed")
+    except Exception as e:
+        logger.warning(f"[Module Load] API client pre-warm failed: {e}")
+
+
+# Pay DNS + TLS setup in the background instead of on the first user's request
+threading.Thread(target=_prewarm_api_client, name='api-prewarm', daemon=True).start()
 
 
 def ai(prompt, instructions, think, model):
@@ -686,19 +1066,17 @@ def ai(prompt, instructions, think, model):
             {"role": "system", "content": instructions},
             {"role": "user", "content": prompt}
         ],
-        "stream": True
+        # Callers always wait for the full answer, so skip per-chunk SSE parsing
+        "stream": False
     }
-    
+
     if think:
         call_args["max_tokens"] = 3000
 
-    stream = client.chat.completions.create(**call_args)
-    answer = ""
-    for chunk in stream:
-        if chunk.choices and chunk.choices[0].delta.content:
-            content = chunk.choices[0].delta.content
-            answer += content
-    return answer
+    response = client.chat.completions.create(**call_args)
+    if not response.choices:
+        return ""
+    return response.choices[0].message.content or ""
 
 
 def ai_stream(prompt, instructions, model):
@@ -716,11 +1094,80 @@ def ai_stream(prompt, instructions, model):
 
     stream = client.chat.completions.create(**call_args)
     for chunk in stream:
-        if chunk.choices and chunk.choices[0].delta.content:
-            content = chunk.choices[0].delta.content
+        choices = chunk.choices
+        if not choices:
+            continue
+        content = choices[0].delta.content
+        if content:
             yield content
 
 
+# Input budgets for internal summarization calls (in tokens)
+SUMMARIZE_INPUT_TOKENS = 8000
+COMPRESS_INPUT_TOKENS = 5000
+CHARS_PER_TOKEN = 4  # Rough estimate used when tiktoken is unavailable
+
+# The build bakes the BPE file into TIKTOKEN_CACHE_DIR (nixpacks.toml), so this is normally
+# a local read. On a cold cache tiktoken downloads it with no timeout, so loading happens on
+# one background thread rather than on the boot path or in racing first requests; until it
+# lands (or if it never does) truncation uses the character estimate.
+_token_encoder = None
+
+
+def _load_token_encoder():
+    global _token_encoder
+    try:
+        _token_encoder = tiktoken.get_encoding('cl100k_base')
+        logger.info("[Module Load] tiktoken encoding loaded")
+    except Exception as e:
+        logger.warning(f"[Module Load] tiktoken encoding unavailable, using character estimate: {e}")
+
+
+if USE_TIKTOKEN:
+    threading.Thread(target=_load_token_encoder, name='tiktoken-load', daemon=True).start()
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Truncate text to roughly max_tokens tokens.
+    
+    Uses tiktoken's cl100k_base encoding when installed (an approximation for
+    non-OpenAI models, but far closer than a raw character count), otherwise
+    falls back to CHARS_PER_TOKEN characters per token.
+    """
+    if not text:
+        return text
+    
+    # Text this short cannot exceed the budget under either measure
+    if len(text) <= max_tokens:
+        return text
+    
+    if _token_encoder is not None:
+        try:
+            tokens = _token_encoder.encode(text, disallowed_special=())
+            if len(tokens) <= max_tokens:
+                return text
+            return _token_encoder.decode(tokens[:max_tokens])
+        except Exception as e:
+            logger.warning(f"Token truncation failed, using character estimate: {e}")
+    
+    return text[:max_tokens * CHARS_PER_TOKEN]
+
+
+def _call_with_retry(prompt, instructions, model, think=False, attempts=2, base_delay=0.25, label="AI call"):
+    """Call ai() and clean its output, retrying with jittered exponential backoff.
+    
+    Raises the last exception if every attempt fails.
+    """
+    for attempt in range(attempts):
+        try:
+            return clean_ai_output(ai(prompt, instructions, think, model))
+        except Exception as e:
+            if attempt == attempts - 1:
+                raise
+            logger.warning(f"{label} attempt {attempt + 1} failed: {e}, retrying...")
+            time.sleep(base_delay * (2 ** attempt) + random.uniform(0, 0.1))
+
+
 def summarize_research(search_data: str, user_question: str) -> str:
     """Summarize raw search data using the summarizer prompt.
     
@@ -734,23 +1181,20 @@ def summarize_research(search_data: str, user_question: str) -> str:
     if not search_data or len(search_data) < 100:
         return ""
     
-    prompt = f"User question: {user_question}\n\nSearch data to summarize:\n{search_data[:40000]}"  # Cap input
+    prompt = f"User question: {user_question}\n\nSearch data to summarize:\n{truncate_to_tokens(search_data, SUMMARIZE_INPUT_TOKENS)}"  # Cap input
     
-    # Retry logic - try twice before giving up
-    for attempt in range(2):
-        try:
-            result = ai(prompt, summarizer, False, fast_general)
-            result = clean_ai_output(result)
-            # Truncate if too long
-            return result[:5000] if result else ""
-        except Exception as e:
-            if attempt == 0:
-                logger.warning(f"Summarization attempt 1 failed: {e}, retrying...")
-                continue  # Retry once
-            logger.warning(f"Summarization failed after retry: {e}")
-            return ""  # Skip on second failure
+    try:
+        result = _call_with_retry(prompt, summarizer, fast_general, label="Summarization")
+    except Exception as e:
+        logger.warning(f"Summarization failed after retry: {e}")
+        return ""  # Skip on final failure
     
-    return ""
+    # Truncate if too long
+    return result[:5000] if result else ""
+
+
+# Shortest history compress_memory will touch (7 user/assistant pairs)
+MEMORY_COMPRESSION_MIN_MESSAGES = 14
 
 
 def compress_memory(memory: list) -> list:
@@ -765,25 +1209,36 @@ def compress_memory(memory: list) -> list:
     if not memory or not isinstance(memory, list):
         return memory
     
-    # Count pairs (user + assistant = 1 pair)
-    # Filter to only count user and assistant messages
-    conversation_messages = [m for m in memory if m.get('role') in ('user', 'assistant')]
-    pairs = len(conversation_messages) // 2
-    
-    if pairs < 7:
+    # 7 pairs need at least 14 messages, so shorter histories can never qualify
+    if len(memory) < MEMORY_COMPRESSION_MIN_MESSAGES:
         return memory
     
-    # Find the first user message and its corresponding assistant response
+    # Single pass: count user/assistant messages (user + assistant = 1 pair) and
+    # find the first user message and its corresponding assistant response
+    conversation_count = 0
     first_user_idx = None
     first_assistant_idx = None
     
     for i, msg in enumerate(memory):
-        if msg.get('role') == 'user' and first_user_idx is None:
-            first_user_idx = i
-        elif msg.get('role') == 'assistant' and first_user_idx is not None and first_assistant_idx is None:
-            first_assistant_idx = i
+        role = msg.get('role')
+        if role == 'user':
+            conversation_count += 1
+            if first_user_idx is None:
+                first_user_idx = i
+        elif role == 'assistant':
+            conversation_count += 1
+            if first_user_idx is not None and first_assistant_idx is None:
+                first_assistant_idx = i
+        
+        # Stop scanning once the threshold is met and the oldest pair is located
+        if conversation_count >= MEMORY_COMPRESSION_MIN_MESSAGES and first_assistant_idx is not None:
             break
     
+    pairs = conversation_count // 2
+    
+    if pairs < 7:
+        return memory
+    
     # If we can't find a valid pair, return original
     if first_user_idx is None or first_assistant_idx is None:
         return memory
@@ -792,22 +1247,20 @@ def compress_memory(memory: list) -> list:
     oldest_assistant = memory[first_assistant_idx]
     
     # Summarize using chat_summary_prompt
-    chat_to_summarize = f"User: {oldest_user.get('content', '')}\n\nAssistant: {oldest_assistant.get('content', '')}"
+    # Pre-slice each side to the whole input budget so a huge message isn't copied in full
+    # only to be truncated below
+    field_cap = COMPRESS_INPUT_TOKENS * CHARS_PER_TOKEN
+    chat_to_summarize = f"User: {oldest_user.get('content', '')[:field_cap]}\n\nAssistant: {oldest_assistant.get('content', '')[:field_cap]}"
     
-    # Retry logic
-    summary = None
-    for attempt in range(2):
-        try:
-            summary = ai(chat_to_summarize[:20000], chat_summary_prompt, False, fast_general)  # Cap input
-            summary = clean_ai_output(summary)
-            break
-        except Exception as e:
-            if attempt == 0:
-                logger.warning(f"Compression attempt 1 failed: {e}, retrying...")
-                continue
-            logger.warning(f"Compression failed after retry: {e}")
-            # On second failure, keep original (don't lose data)
-            return memory
+    try:
+        summary = _call_with_retry(
+            truncate_to_tokens(chat_to_summarize, COMPRESS_INPUT_TOKENS),  # Cap input
+            chat_summary_prompt, fast_general, label="Compression"
+        )
+    except Exception as e:
+        logger.warning(f"Compression failed after retry: {e}")
+        # On final failure, keep original (don't lose data)
+        return memory
     
     # If summary is empty or too short, keep original
     if not summary or len(summary) < 20:
@@ -822,15 +1275,136 @@ def compress_memory(memory: list) -> list:
         "content": f"[Compressed conversation summary]: {summary}"
     }
     
-    # Build new memory: everything before first_user, compressed message, everything after first_assistant
-    new_memory = memory[:first_user_idx] + [compressed_message] + memory[first_assistant_idx + 1:]
+    # Splice the compressed message over the pair in place - memory is the request's own
+    # list, so this avoids copying the whole tail into a new list
+    memory[first_user_idx:first_assistant_idx + 1] = [compressed_message]
     
-    return new_memory
+    return memory
+
+
+# LRU cache for follow-up search decisions, keyed by prompt + last conversation turn
+_IF_SEARCH_CACHE_MAX = 512
+_if_search_cache = OrderedDict()
+_if_search_lock = threading.Lock()
+
+
+def _if_search_cache_key(prompt: str, memory: list) -> bytes:
+    """Build a compact cache key from the prompt and the last memory turn."""
+    last_turn = ""
+    if memory and isinstance(memory[-1], dict):
+        last_turn = str(memory[-1].get('content', ''))
+    raw = (prompt + "||" + last_turn)[:4096]
+    return hashlib.blake2b(raw.encode('utf-8', 'ignore'), digest_size=16).digest()
+
+
+def should_search_follow_up(prompt: str, memory: list) -> bool:
+    """Decide whether a follow-up question needs a web search.
+    
+    Decisions are cached so repeated follow-ups skip the model round-trip.
+    """
+    key = _if_search_cache_key(prompt, memory)
+    with _if_search_lock:
+        cached = _if_search_cache.get(key)
+        if cached is not None:
+            _if_search_cache.move_to_end(key)
+            return cached
+    
+    if_search = ai(
+        "User question: " + prompt,
+        "Job: This is a follow up question please decide if to answer it a internet search should be done. If yes please respond with <search> if no please respond with <no search>.",
+        False, general
+    )
+    decision = "<search>" in clean_ai_output(if_search)
+    
+    with _if_search_lock:
+        _if_search_cache[key] = decision
+        _if_search_cache.move_to_end(key)
+        if len(_if_search_cache) > _IF_SEARCH_CACHE_MAX:
+            _if_search_cache.popitem(last=False)
+    return decision
+
+
+# Line breaks and tabs flattened to spaces in the single-line text preview (one C-level pass)
+_PREVIEW_WS_TABLE = str.maketrans({'\n': ' ', '\r': ' ', '\t': ' '})
+
+# Upper bound on search -> evaluate rounds per message
+MAX_SEARCH_ITERATIONS = 4
+# Below this much gathered text the goodness evaluation is skipped and another round is run
+MIN_EVAL_TEXT_CHARS = 500
+
+# Goodness verdicts keyed by a blake2b digest of (prompt, gathered data) - identical
+# evaluations (retries, regenerated answers) reuse the verdict instead of re-asking the model
+_goodness_cache = TTLCache(maxsize=1024, ttl=300)
+_goodness_cache_lock = threading.Lock()
+
+# First-round generated search queries keyed the same way - a resent or regenerated
+# message with the same history skips the query-generation call
+_query_gen_cache = TTLCache(maxsize=1024, ttl=300)
+_query_gen_cache_lock = threading.Lock()
+
+# How long the final answer waits for the previous-research summary before streaming without it
+SUMMARY_WAIT_SECONDS = 0.5
+SEARCH_BATCH_WINDOW = 0.02
+# Images offered to the answer model - more than this only overwhelms it
+MAX_PROMPT_IMAGES = 25
+
+# A single page this long that covers most of the prompt's keywords is enough to answer from
+# in the first round - the remaining queries are dropped instead of waiting on slow tail fetches
+EARLY_EXIT_MIN_CHARS = 3000
+EARLY_EXIT_KEYWORD_RATIO = 0.75
+EARLY_EXIT_MIN_KEYWORDS = 2
+_KEYWORD_RE = re.compile(r"[a-z0-9]{4,}")
+_KEYWORD_STOP_WORDS = frozenset((
+    "about", "after", "also", "been", "before", "best", "between", "could", "does", "doing",
+    "each", "explain", "find", "from", "give", "have", "here", "into", "just", "know", "like",
+    "long", "make", "many", "more", "most", "much", "need", "only", "other", "over", "please",
+    "should", "show", "some", "such", "tell", "than", "that", "their", "them", "then", "there",
+    "these", "they", "thing", "things", "this", "those", "want", "were", "what", "when", "where",
+    "which", "while", "will", "with", "would", "year", "years", "your",
+))
+
+
+def prompt_keywords_for(prompt):
+    """Content words of the prompt used by is_sufficient (stop words removed)."""
+    return frozenset(_KEYWORD_RE.findall(prompt.lower())) - _KEYWORD_STOP_WORDS
+
+
+def is_sufficient(full_text, keywords):
+    """Cheap check that one scrape result can stand on its own for the answer."""
+    # Too few content words to judge relevance - never stop early on a guess
+    if len(keywords) < EARLY_EXIT_MIN_KEYWORDS or len(full_text) < EARLY_EXIT_MIN_CHARS:
+        return False
+    text = full_text.lower()
+    hits = sum(k in text for k in keywords)
+    return hits >= len(keywords) * EARLY_EXIT_KEYWORD_RATIO
+
+SEARCH_RESULTS_SEPARATOR = "\n\n=== COMBINED SEARCH RESULTS ===\n\n"
+
+
+def bounded_join(parts, sep, cap):
+    """Equivalent to sep.join(parts)[:cap] without building the full joined string."""
+    out = []
+    size = 0
+    for i, part in enumerate(parts):
+        if i:
+            out.append(sep)
+            size += len(sep)
+            if size >= cap:
+                break
+        out.append(part)
+        size += len(part)
+        if size >= cap:
+            break
+    return "".join(out)[:cap]
 
 
 def process_search(prompt, memory, previous_search_data=None, previous_user_question=None, session_id=None, fast_mode=False):
     """Process the search workflow and yield status updates and final streaming response.
     
+    Yields event dicts, lists of event dicts that were produced together and
+    should be sent to the client in a single write, or (for streamed answer
+    tokens) already framed SSE bytes.
+    
     Args:
         prompt: The user's current message
         memory: Conversation history as list of {role, content} dicts
@@ -840,8 +1414,11 @@ def process_search(prompt, memory, previous_search_data=None, previous_user_ques
         fast_mode: If True, use faster search prompt and skip goodness loop for quicker responses
     """
     search_data = []
+    # Goodness-eval view of search_data, appended as results land so each round only adds its new text
+    eval_buf = io.StringIO()
+    search_data_chars = 0
     search_history = []  # Track all searches for frontend
-    all_images = []  # Collect images from all search results
+    all_images_by_url = {}  # Collect images from all search results, de-duplicated by URL (insertion ordered)
     iter_count = 0
     searching = True
     no_search = False
@@ -849,55 +1426,68 @@ def process_search(prompt, memory, previous_search_data=None, previous_user_ques
     service_failure_detected = False  # Track if search service is down
     research_summary = ""  # Will hold summarized previous research
     summary_future = None  # Future for parallel summarization
+    prompt_keywords = prompt_keywords_for(prompt)
     
     # Yield immediate status so frontend knows we're processing
-    status_info = get_status_with_cycle_options("thinking")
-    yield {
-        "type": "status", 
-        "message": status_info["message"], 
-        "step": 0, 
-        "icon": "thinking",
-        "cycleMessages": status_info.get("cycleMessages"),
-        "cycleInterval": status_info.get("cycleInterval")
-    }
-    
-    # Compress memory if it has 7+ conversation pairs (this may block if compression needed)
-    memory = compress_memory(memory)
-    
-    # Check if this is a follow-up that needs searching
+    yield {**_INITIAL_THINKING_EVENT, "message": get_status_message("thinking")}
+    
+    def generate_first_query():
+        # Use fast search prompt when fast_mode is enabled (single query, lower depth)
+        query_input = "User question:" + prompt + " Memory: " + orjson.dumps(memory).decode()
+        query_instructions = search_fast_prompt() if fast_mode else search_prompt()
+        
+        # Identical question + history (+ same dated prompt) -> reuse the generated queries
+        query_key = hashlib.blake2b(
+            (query_instructions + "\x00" + query_input).encode('utf-8', 'surrogatepass'), digest_size=16
+        ).digest()
+        with _query_gen_cache_lock:
+            cached = _query_gen_cache.get(query_key)
+        if cached is not None:
+            return cached
+        
+        generated = ai(query_input, query_instructions, False, researcher)
+        if generated:
+            with _query_gen_cache_lock:
+                _query_gen_cache[query_key] = generated
+        return generated
+    
+    first_query_future = None  # Speculative first-round query generation
+    
+    # Check if this is a follow-up that needs searching. Memory compression (7+ pairs)
+    # and the follow-up decision are independent model calls, so run them together -
+    # compression on this request's own thread, the rest on the pool.
     if memory:
-        status_info = get_status_with_cycle_options("thinking")
-        yield {
-            "type": "status", 
-            "message": status_info["message"], 
-            "step": 0, 
-            "icon": "thinking",
-            "cycleMessages": status_info.get("cycleMessages"),
-            "cycleInterval": status_info.get("cycleInterval")
-        }
-        if_search = ai(
-            "User question: " + prompt,
-            "Job: This is a follow up question please decide if to answer it a internet search should be done. If yes please respond with <search> if no please respond with <no search>.",
-            False, general
-        )
-        if_search = clean_ai_output(if_search)
-        if "<search>" not in if_search:
+        if_search_future = _AI_CALL_POOL.submit(should_search_follow_up, prompt, memory)
+        
+        # Below the compression threshold memory won't change, so the first search query
+        # can be generated alongside the follow-up decision instead of after it. This is a
+        # deliberate trade: the pool normally starts the job at once, so when the follow-up
+        # turns out to need no search the query-generation call has already been paid for
+        # and its result is simply dropped
+        if len(memory) < MEMORY_COMPRESSION_MIN_MESSAGES:
+            first_query_future = _AI_CALL_POOL.submit(generate_first_query)
+        
+        # The initial thinking status above is already on the client while these run
+        memory = compress_memory(memory)
+        if not if_search_future.result():
             searching = False
+            if first_query_future is not None:
+                # Only saves the call if the pool was saturated and the job hasn't started;
+                # usually it is already running and finishes in the background
+                first_query_future.cancel()
     
     # Start parallel summarization of previous search data if:
     # 1. Current message will trigger a search (searching == True)
     # 2. We have previous search data to summarize
     # This runs in parallel with the search to minimize latency
-    summarization_executor = None
     if searching and previous_search_data and len(previous_search_data) > 100:
-        summarization_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
-        summary_future = summarization_executor.submit(
+        summary_future = _AI_CALL_POOL.submit(
             summarize_research, 
             previous_search_data, 
             previous_user_question or prompt  # Use previous question if available, else current
         )
     
-    while searching and iter_count < 4:
+    while searching and iter_count < MAX_SEARCH_ITERATIONS:
         # Only allow skip after first iteration (when goodness loop decides more search needed)
         in_goodness_loop = iter_count > 0
         
@@ -930,14 +1520,10 @@ def process_search(prompt, memory, previous_search_data=None, previous_user_ques
             # In fast mode, this block should never execute since we skip the goodness loop
             query = ai(
                 "User question: " + prompt + " Your original query: " + query + " Failed, please make a new better suited query.",
-                search_fast_prompt if fast_mode else search_prompt, False, researcher
+                search_fast_prompt() if fast_mode else search_prompt(), False, researcher
             )
         elif iter_count == 0:
-            # Use fast search prompt when fast_mode is enabled (single query, lower depth)
-            query = ai(
-                "User question:" + prompt + " Memory: " + str(memory),
-                search_fast_prompt if fast_mode else search_prompt, False, researcher
-            )
+            query = first_query_future.result() if first_query_future is not None else generate_first_query()
         
         # Clean AI output to remove thinking tags
         query = clean_ai_output(query)
@@ -957,23 +1543,22 @@ def process_search(prompt, memory, previous_search_data=None, previous_user_ques
                 continue
             
             # Extract depth using regex (handles "depth3", "depth 3", "Depth3", etc.)
-            depth_match = re.search(r'depth\s*(\d+)', q, re.IGNORECASE)
+            depth_match = _DEPTH_RE.search(q)
             if depth_match:
                 query_depth = min(max(int(depth_match.group(1)), 1), 10)
-                q = re.sub(r'depth\s*\d+', '', q, flags=re.IGNORECASE).strip()
+                # Strip the matched span directly rather than re-scanning with sub()
+                q = (q[:depth_match.start()] + q[depth_match.end():]).strip()
             else:
                 query_depth = 5  # Default
             
             if q and len(q) > 2:
                 queries_with_depth.append((q, query_depth))
-                logger.debug(f"[DEPTH] Query: '{q[:40]}...' -> depth={query_depth}")
+                logger.debug("[DEPTH] Query: '%s...' -> depth=%d", q[:40], query_depth)
         
         # Fallback if no valid queries
         if not queries_with_depth:
             queries_with_depth = [(query, 5)]
         
-        queries = [q for q, _ in queries_with_depth]
-        
         # Check for skip before starting searches (only if in goodness loop)
         if in_goodness_loop and session_id and check_skip_search(session_id):
             yield {
@@ -987,97 +1572,139 @@ def process_search(prompt, memory, previous_search_data=None, previous_user_ques
             break
         
         # Step 2: Send initial searching status for each query - canSkip only in goodness loop
-        for q_idx, q in enumerate(queries):
-            yield {
+        # Batched so all queries' events go out in a single write
+        pending_events = []
+        for q_idx, (q, _) in enumerate(queries_with_depth):
+            pending_events.append({
                 "type": "status", 
                 "message": get_status_message("searching"), 
                 "step": 2, 
                 "icon": "searching",
                 "canSkip": in_goodness_loop  # Only allow skip in goodness loop
-            }
+            })
             # Send search event immediately with query (sources pending)
-            yield {
+            pending_events.append({
                 "type": "search",
                 "query": q,
                 "sources": [],
                 "iteration": iter_count + 1,
                 "queryIndex": q_idx + 1,
                 "status": "searching"
-            }
+            })
+        yield pending_events
         
         # Search all queries in parallel using ThreadPoolExecutor
+        # Set on early exit so dropped queries stop fetching pages they no longer need
+        round_cancelled = threading.Event()
+        
         def search_single_query(q, depth):
-            return grabbers.search_and_scrape(q, depth)
+            return grabbers.search_and_scrape(q, depth, round_cancelled)
         
         # Store results with their query index for ordering
         search_results = {}
         text_preview_sent = False  # Track if we've sent a text preview yet
         
-        with concurrent.futures.ThreadPoolExecutor(max_workers=len(queries)) as executor:
-            future_to_query = {executor.submit(search_single_query, q, d): (idx, q) for idx, (q, d) in enumerate(queries_with_depth)}
-            
-            for future in concurrent.futures.as_completed(future_to_query):
+        future_to_query = {SEARCH_POOL.submit(search_single_query, q, d): (idx, q) for idx, (q, d) in enumerate(queries_with_depth)}
+        
+        # Queries finishing within SEARCH_BATCH_WINDOW of each other go out in one write;
+        # the first batch is flushed as soon as anything lands
+        pending = set(future_to_query)
+        batch_window = 0
+        # Only the first round (or fast mode) may stop early; refinement rounds exist to fill gaps
+        allow_early_exit = fast_mode or iter_count == 0
+        sufficient = False
+        while pending:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            if pending and batch_window:
+                more, pending = concurrent.futures.wait(pending, timeout=batch_window)
+                done |= more
+            batch_window = SEARCH_BATCH_WINDOW
+            events = []
+            for future in sorted(done, key=lambda f: future_to_query[f][0]):
                 idx, q = future_to_query[future]
                 try:
                     scrape_result = future.result()
-                    search_results[idx] = (q, scrape_result)
-                    
+                
                     # Send text preview immediately when FIRST result with content arrives
                     if not text_preview_sent:
                         full_text = scrape_result.get('full_text', '')
                         if full_text and len(full_text) > 50:
-                            text_preview = full_text[:800].replace('\n', ' ').strip()
+                            text_preview = full_text[:800].translate(_PREVIEW_WS_TABLE).strip()
                             text_preview_sent = True
-                            logger.debug(f"[TEXTPREVIEW] Sending preview from query '{q[:30]}...', length={len(text_preview)}")
-                            yield {
+                            logger.debug("[TEXTPREVIEW] Sending preview from query '%s...', length=%d", q[:30], len(text_preview))
+                            events.append({
                                 "type": "text_preview",
                                 "text": text_preview,
                                 "iteration": iter_count + 1
-                            }
+                            })
                 except Exception as e:
                     logger.warning(f"Error searching query '{q[:50]}...': {e}")
-                    search_results[idx] = (q, {'sources': [], 'full_text': 'Search failed', 'images': [], 'service_available': False})
-        
+                    scrape_result = {'sources': [], 'full_text': 'Search failed', 'images': [], 'service_available': False}
+                search_results[idx] = (q, scrape_result)
+                if allow_early_exit and not sufficient:
+                    sufficient = is_sufficient(scrape_result.get('full_text', ''), prompt_keywords)
+            
+                # Mark this query complete as soon as it lands - the UI places it by queryIndex,
+                # so fast queries don't wait behind slow ones
+                events.append({
+                    "type": "search",
+                    "query": q,
+                    "sources": scrape_result.get('sources', []),
+                    "iteration": iter_count + 1,
+                    "queryIndex": idx + 1,
+                    "status": "complete"
+                })
+            
+            if sufficient and pending:
+                # Queued queries are cancelled outright; running ones see round_cancelled and
+                # skip any page they haven't started fetching, and their results are discarded.
+                # Dropped queries stay out of search_data and search_history, but the client
+                # already shows them as "searching", so each still gets a terminal event
+                round_cancelled.set()
+                cancelled = sum(f.cancel() for f in pending)
+                logger.info("[SEARCH] Enough content early - dropping %d pending queries (%d cancelled before start)", len(pending), cancelled)
+                for future in sorted(pending, key=lambda f: future_to_query[f][0]):
+                    idx, q = future_to_query[future]
+                    events.append({
+                        "type": "search",
+                        "query": q,
+                        "sources": [],
+                        "iteration": iter_count + 1,
+                        "queryIndex": idx + 1,
+                        "status": "complete"
+                    })
+                pending = set()
+            yield events
+    
         # Check if search service is down (all queries failed with service_available=False)
-        service_unavailable_count = sum(
-            1 for idx in range(len(queries))
-            if not search_results.get(idx, (None, {}))[1].get('service_available', True)
-        )
-        if service_unavailable_count == len(queries):
+        if not any(r.get('service_available', True) for _, r in search_results.values()):
             # All searches failed due to service being down - don't retry
             service_failure_detected = True
             logger.warning("Search service appears to be down - skipping further search attempts")
         
-        # Process results in order and yield events
-        for idx in range(len(queries)):
+        # Collect results in query order so the prompt and history stay deterministic
+        for idx in sorted(search_results):
             q, scrape_result = search_results[idx]
-            sources = scrape_result.get('sources', [])
-            full_text = scrape_result.get('full_text', '')
-            images = scrape_result.get('images', [])
             
+            full_text = scrape_result.get('full_text', '')
+            if search_data:
+                eval_buf.write("\n\n---\n\n")
+            eval_buf.write(full_text)
+            search_data_chars += len(full_text)
             search_data.append(full_text)
-            all_images.extend(images)  # Collect images from all results
+            # Collect images from all results; only the first MAX_PROMPT_IMAGES unique URLs are ever used
+            for img in scrape_result.get('images', ()):
+                if len(all_images_by_url) >= MAX_PROMPT_IMAGES:
+                    break
+                all_images_by_url.setdefault(img['url'], img)
             
             # Create search entry for history
-            search_entry = {
+            search_history.append({
                 "query": q,
-                "sources": sources,
+                "sources": scrape_result.get('sources', []),
                 "iteration": iter_count + 1,
                 "queryIndex": idx + 1
-            }
-            search_history.append(search_entry)
-            
-            # Build search event with sources
-            search_event = {
-                "type": "search",
-                "query": q,
-                "sources": sources,
-                "iteration": iter_count + 1,
-                "queryIndex": idx + 1,
-                "status": "complete"
-            }
-            
-            yield search_event
+            })
         
         # If search service is down, exit the loop - don't waste time evaluating or retrying
         if service_failure_detected:
@@ -1131,16 +1758,36 @@ def process_search(prompt, memory, previous_search_data=None, previous_user_ques
         # In fast mode, skip the goodness evaluation entirely - just use first search results
         if fast_mode:
             good = "<<<SEARCH_COMPLETE>>>"  # Fake completion to skip loop
+        elif iter_count == MAX_SEARCH_ITERATIONS - 1 and not any(r.get('sources') for _, r in search_results.values()):
+            # Nothing was found in the last round - there's no round left to reword the query in.
+            # Earlier empty rounds fall through so the next round can rephrase the search
+            good = "<<<SEARCH_COMPLETE>>>"
+        elif search_data_chars < MIN_EVAL_TEXT_CHARS and iter_count < MAX_SEARCH_ITERATIONS - 1:
+            # Too little text to judge; the evaluator would only ask for more anyway
+            good = "<<<NEEDS_MORE_SEARCH>>>"
         else:
-            # Combine search data for evaluation
-            eval_search_data = "\n\n---\n\n".join(search_data) if search_data else ""
-            good = ai(
-                "User prompt: " + prompt + "\n\nInformation gathered:\n" + eval_search_data,
-                goodness_decided_prompt, False, general
-            )
+            eval_search_data = eval_buf.getvalue()
+            eval_key = hashlib.blake2b(
+                (prompt + "\x00" + eval_search_data).encode('utf-8', 'surrogatepass'), digest_size=16
+            ).digest()
+            with _goodness_cache_lock:
+                good = _goodness_cache.get(eval_key)
             
-            # Clean AI output to remove thinking tags
-            good = clean_ai_output(good)
+            if good is None:
+                eval_input = "User prompt: " + prompt + "\n\nInformation gathered:\n" + eval_search_data
+                if in_goodness_loop:
+                    # A skip aborts the wait (good is None; the check below breaks)
+                    eval_future = _AI_CALL_POOL.submit(ai, eval_input, goodness_decided_prompt, False, general)
+                    good = result_unless_skipped(eval_future, session_id)
+                else:
+                    # Nothing can interrupt the first round, so there's no reason to leave this thread
+                    good = ai(eval_input, goodness_decided_prompt, False, general)
+                
+                if good is not None:
+                    # Clean AI output to remove thinking tags
+                    good = clean_ai_output(good)
+                    with _goodness_cache_lock:
+                        _goodness_cache[eval_key] = good
         
         # Check for skip request after evaluation AI call (it may take a while) - only in goodness loop
         if in_goodness_loop and session_id and check_skip_search(session_id):
@@ -1172,21 +1819,20 @@ def process_search(prompt, memory, previous_search_data=None, previous_user_ques
         
         iter_count += 1
     
-    # Collect summarization result if it was started
+    # Collect summarization result if it is ready. It has been running since before the
+    # search started, so it is normally done by now; never hold up the answer for it.
     if summary_future is not None:
-        try:
-            research_summary = summary_future.result(timeout=30)  # 30 second timeout
-            logger.debug(f"Research summarization completed: {len(research_summary)} chars")
-        except concurrent.futures.TimeoutError:
-            logger.warning("Research summarization timed out, skipping")
-            research_summary = ""
-        except Exception as e:
-            logger.warning(f"Research summarization failed: {e}")
-            research_summary = ""
-    
-    # Clean up the summarization executor
-    if summarization_executor is not None:
-        summarization_executor.shutdown(wait=False)
+        done, _ = concurrent.futures.wait([summary_future], timeout=SUMMARY_WAIT_SECONDS)
+        if done:
+            try:
+                research_summary = summary_future.result()
+                logger.debug("Research summarization completed: %d chars", len(research_summary))
+            except Exception as e:
+                logger.warning(f"Research summarization failed: {e}")
+                research_summary = ""
+        else:
+            logger.warning("Research summarization not ready, answering without it")
+            summary_future.cancel()
     
     # Step 4: Generate final response with streaming
     yield {
@@ -1196,45 +1842,46 @@ def process_search(prompt, memory, previous_search_data=None, previous_user_ques
         "icon": "generating"
     }
     
-    # Combine all search data into a single formatted string
-    combined_search_data = "\n\n=== COMBINED SEARCH RESULTS ===\n\n".join(search_data) if search_data else ""
-    
-    # Store raw search data for returning to frontend (capped at 50KB)
-    raw_search_data_for_return = combined_search_data[:50000] if combined_search_data else ""
-    
-    # Free memory from search_data list before streaming
-    search_data.clear()
-    gc.collect()
+    # Store raw search data for returning to frontend (capped at 50KB) - the bounded join
+    # stops copying once the cap is reached instead of slicing the full combined string
+    raw_search_data_for_return = bounded_join(search_data, SEARCH_RESULTS_SEPARATOR, 50000)
     
+    # Build the prompt in one join so the (large) search data is copied only once
+    prompt_parts = ["User question: ", prompt, "\n\nSearch data: " if no_search else "\n\nSearch data:\n"]
+    for i, part in enumerate(search_data):
+        if i:
+            prompt_parts.append(SEARCH_RESULTS_SEPARATOR)
+        prompt_parts.append(part)
     if no_search:
-        prompt_text = "User question: " + prompt + "\n\nSearch data: " + combined_search_data + "\n\nNo data has been given just answer the users question truthfully"
-    else:
-        prompt_text = "User question: " + prompt + "\n\nSearch data:\n" + combined_search_data
+        prompt_parts.append("\n\nNo data has been given just answer the users question truthfully")
     
     # Add available images to the prompt if any were found
-    if all_images:
-        # Limit to 25 images max to avoid overwhelming the AI
-        available_images = all_images[:25]
-        images_text = "\n\nAvailable Images (use §IMG:url§ to reference):\n"
-        for i, img in enumerate(available_images, 1):
+    if all_images_by_url:
+        # Already capped at MAX_PROMPT_IMAGES while collecting
+        prompt_parts.append("\n\nAvailable Images (use §IMG:url§ to reference):\n")
+        for i, img in enumerate(all_images_by_url.values(), 1):
             alt_text = f" - {img['alt']}" if img.get('alt') else ""
-            images_text += f"{i}. {img['url']}{alt_text}\n"
-        prompt_text += images_text
+            prompt_parts.append(f"{i}. {img['url']}{alt_text}\n")
+    
+    prompt_text = "".join(prompt_parts)
+    
+    # Free the per-query search text before streaming (refcounting releases it immediately)
+    del prompt_parts
+    search_data.clear()
     
     # Build instructions with memory and research summary
-    instructions = main_prompt + " Memory from previous conversation: " + str(memory)
+    instruction_parts = [main_prompt(), " Memory from previous conversation: ", orjson.dumps(memory).decode()]
     
     # Add research summary from previous conversation if available
     if research_summary:
-        instructions += f"\n\nSummarized research from previous conversation:\n{research_summary}"
+        instruction_parts.append("\n\nSummarized research from previous conversation:\n")
+        instruction_parts.append(research_summary)
     
-    # Free combined_search_data after building prompt
-    del combined_search_data
-    gc.collect()
+    instructions = "".join(instruction_parts)
     
     # Stream the final response
     for chunk in ai_stream(prompt_text, instructions, general):
-        yield {"type": "content", "data": chunk}
+        yield sse_content(chunk)
     
     # Send done event with complete search history and raw search data
     yield {
@@ -1252,6 +1899,21 @@ MAX_MESSAGE_LENGTH = 10000  # 10KB limit for chat messages
 MAX_MEMORY_ITEMS = 50  # Maximum conversation history items
 
 
+def sse_event(payload: dict) -> bytes:
+    """Frame a payload as a Server-Sent Event, pre-encoded so the WSGI server writes it as-is."""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+
+# Constant head/tail of a {"type": "content", "data": ...} frame; only the token is encoded per event
+_CONTENT_FRAME_HEAD = b'data: {"type":"content","data":'
+_CONTENT_FRAME_TAIL = b'}\n\n'
+
+
+def sse_content(chunk: str) -> bytes:
+    """Frame one streamed answer token; byte-identical to sse_event({"type": "content", "data": chunk})."""
+    return b"".join((_CONTENT_FRAME_HEAD, orjson.dumps(chunk), _CONTENT_FRAME_TAIL))
+
+
 @app.route('/api/chat', methods=['POST'])
 @limiter.limit("30 per minute")
 @require_auth
@@ -1271,14 +1933,14 @@ def chat():
     # Input validation
     if not message:
         return Response(
-            json.dumps({"error": "No message provided"}),
+            orjson.dumps({"error": "No message provided"}),
             status=400,
             mimetype='application/json'
         )
     
     if len(message) > MAX_MESSAGE_LENGTH:
         return Response(
-            json.dumps({"error": f"Message too long. Maximum {MAX_MESSAGE_LENGTH} characters allowed"}),
+            orjson.dumps({"error": f"Message too long. Maximum {MAX_MESSAGE_LENGTH} characters allowed"}),
             status=400,
             mimetype='application/json'
         )
@@ -1291,7 +1953,7 @@ def chat():
     success, remaining, error = check_and_deduct_credits(user_id, 2)
     if not success:
         return Response(
-            json.dumps({"error": error or "Insufficient credits", "credits": remaining}),
+            orjson.dumps({"error": error or "Insufficient credits", "credits": remaining}),
             status=402,  # Payment Required
             mimetype='application/json'
         )
@@ -1306,12 +1968,21 @@ def chat():
     def generate():
         try:
             # Send session_id to frontend first so they can use it for skip requests
-            yield f"data: {json.dumps({'type': 'session', 'sessionId': session_id})}\n\n"
+            yield sse_event({'type': 'session', 'sessionId': session_id})
             
             for update in process_search(message, memory, previous_search_data, previous_user_question, session_id, fast_mode):
-                yield f"data: {json.dumps(update)}\n\n"
+                if isinstance(update, bytes):
+                    # Already framed (streamed answer tokens)
+                    yield update
+                elif isinstance(update, list):
+                    # Coalesce batched events into one chunk -> one socket write
+                    touch_session(session_id)
+                    yield b"".join(sse_event(event) for event in update)
+                else:
+                    touch_session(session_id)
+                    yield sse_event(update)
         except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
+            yield sse_event({'type': 'error', 'message': str(e)})
         finally:
             # Clean up session after request completes
             cleanup_session(session_id)
@@ -1320,7 +1991,8 @@ def chat():
         stream_with_context(generate()),
         mimetype='text/event-stream',
         headers={
-            'Cache-Control': 'no-cache',
+            # no-transform stops intermediaries from compressing (and thus buffering) the stream
+            'Cache-Control': 'no-cache, no-transform',
             'Connection': 'keep-alive',
             'X-Accel-Buffering': 'no'
         }
@@ -1337,7 +2009,7 @@ def skip_search():
     
     if not session_id:
         return Response(
-            json.dumps({"error": "No sessionId provided"}),
+            orjson.dumps({"error": "No sessionId provided"}),
             status=400,
             mimetype='application/json'
         )
@@ -1345,7 +2017,7 @@ def skip_search():
     success = request_skip_search(session_id)
     
     return Response(
-        json.dumps({"success": success, "sessionId": session_id}),
+        orjson.dumps({"success": success, "sessionId": session_id}),
         status=200,
         mimetype='application/json'
     )
@@ -1364,12 +2036,12 @@ def create_checkout():
     
     # Initialize Stripe
     config = get_stripe_config()
-    logger.debug(f"[Checkout] Config loaded - API key set: {bool(stripe.api_key)}")
+    logger.debug("[Checkout] Config loaded - API key set: %s", bool(stripe.api_key))
     
     if not stripe.api_key:
         logger.error("[Checkout] Stripe API key not configured")
         return Response(
-            json.dumps({"error": "Payment service not configured"}),
+            orjson.dumps({"error": "Payment service not configured"}),
             status=500,
             mimetype='application/json'
         )
@@ -1377,7 +2049,7 @@ def create_checkout():
     if not config.get('price_id'):
         logger.error("[Checkout] Stripe price ID not configured")
         return Response(
-            json.dumps({"error": "Payment service not configured"}),
+            orjson.dumps({"error": "Payment service not configured"}),
             status=500,
             mimetype='application/json'
         )
@@ -1387,8 +2059,12 @@ def create_checkout():
         db = get_firestore_db()
         existing_customer_id = None
         
-        if db:
-            user_doc = db.collection('users').document(user_id).get()
+        # Repeat clicks within the TTL skip the Firestore read
+        with _customer_cache_lock:
+            existing_customer_id = _customer_cache.get(user_id)
+        
+        if db and not existing_customer_id:
+            user_doc = _user_ref(db, user_id).get()
             if user_doc.exists:
                 user_data = user_doc.to_dict()
                 existing_customer_id = user_data.get('stripeCustomerId')
@@ -1396,7 +2072,7 @@ def create_checkout():
         # Create or reuse customer
         if existing_customer_id:
             customer_id = existing_customer_id
-            logger.debug(f"[Checkout] Reusing existing Stripe customer")
+            logger.debug("[Checkout] Reusing existing Stripe customer")
         else:
             # Create a new Stripe customer
             customer_params = {'metadata': {'firebaseUserId': user_id}}
@@ -1404,14 +2080,17 @@ def create_checkout():
                 customer_params['email'] = user_email
             customer = stripe.Customer.create(**customer_params)
             customer_id = customer.id
-            logger.debug(f"[Checkout] New Stripe customer created")
+            logger.debug("[Checkout] New Stripe customer created")
             
             # Store customer ID in Firestore
             if db:
-                db.collection('users').document(user_id).set({
+                _user_ref(db, user_id).set({
                     'stripeCustomerId': customer_id
                 }, merge=True)
         
+        with _customer_cache_lock:
+            _customer_cache[user_id] = customer_id
+        
         # Create Checkout session
         checkout_session = stripe.checkout.Session.create(
             customer=customer_id,
@@ -1435,7 +2114,7 @@ def create_checkout():
         
         logger.info(f"[Checkout] Session created for user {user_id[:8]}...")
         return Response(
-            json.dumps({"url": checkout_session.url, "sessionId": checkout_session.id}),
+            orjson.dumps({"url": checkout_session.url, "sessionId": checkout_session.id}),
             status=200,
             mimetype='application/json'
         )
@@ -1443,24 +2122,253 @@ def create_checkout():
     except stripe.error.StripeError as e:
         logger.error(f"[Checkout] Stripe error: {type(e).__name__}")
         return Response(
-            json.dumps({"error": "Payment processing failed"}),
+            orjson.dumps({"error": "Payment processing failed"}),
             status=400,
             mimetype='application/json'
         )
     except Exception as e:
         logger.error(f"[Checkout] Exception: {type(e).__name__}: {e}")
-        logger.debug(traceback.format_exc())
+        logger.debug("[Checkout] Exception traceback", exc_info=True)
         return Response(
-            json.dumps({"error": "Failed to create checkout session"}),
+            orjson.dumps({"error": "Failed to create checkout session"}),
             status=500,
             mimetype='application/json'
         )
 
 
+# Processed Stripe event ids. Every webhook write batch also create()s the event's marker
+# doc, so a redelivered event - or a retry of a commit that timed out but actually landed -
+# fails with AlreadyExists instead of applying its Increments twice. Markers carry an
+# expiresAt for a Firestore TTL policy; Stripe stops redelivering well before then.
+STRIPE_EVENTS_COLLECTION = 'stripe_events'
+STRIPE_EVENT_MARKER_TTL_DAYS = 30
+
+
+def _stripe_event_ref(db, event):
+    return db.collection(STRIPE_EVENTS_COLLECTION).document(event['id'])
+
+
+def _event_batch(db, event):
+    """A write batch that records the event as processed when it commits."""
+    batch = db.batch()
+    batch.create(_stripe_event_ref(db, event), {
+        'type': event['type'],
+        'processedAt': firestore.SERVER_TIMESTAMP,
+        'expiresAt': datetime.now() + timedelta(days=STRIPE_EVENT_MARKER_TTL_DAYS),
+    })
+    return batch
+
+
+def _handle_stripe_event(event, db):
+    """Apply the Firestore side effects of a verified Stripe event.
+    
+    Raises on failure so the webhook can answer non-2xx and Stripe redelivers; raises
+    AlreadyExists if the event was already applied.
+    """
+    event_type = event['type']
+    
+    # Cheap early out for redeliveries; the create() in each batch is what makes it safe
+    if _stripe_event_ref(db, event).get().exists:
+        raise gcp_exceptions.AlreadyExists(f"Stripe event {event['id']} already processed")
+    
+    if event_type == 'checkout.session.completed':
+        session = event['data']['object']
+        
+        user_id = session.get('metadata', {}).get('firebaseUserId')
+        subscription_id = session.get('subscription')
+        customer_id = session.get('customer')
+        
+        if not user_id:
+            logger.error("[Webhook] No firebaseUserId in checkout session metadata")
+            return
+        
+        # Log only truncated user ID for privacy
+        logger.info(f"[Webhook] Processing checkout for user {user_id[:8]}...")
+        
+        # Check if user was on waitlist (buying premium to skip)
+        user_doc = _user_ref(db, user_id).get()
+        was_on_waitlist = False
+        user_data = {}
+        if user_doc.exists:
+            user_data = user_doc.to_dict()
+            was_on_waitlist = user_data.get('onWaitlist', False)
+        
+        # Update user to premium
+        premium_update = {
+            'isPremium': True,
+            'stripeCustomerId': customer_id,
+            'stripeSubscriptionId': subscription_id,
+            'subscriptionStatus': 'active',
+            'credits': 200,  # Give them premium credits immediately
+            'onWaitlist': False,  # Remove from waitlist if they were on it
+            'registeredAsFree': False,  # No longer a free user
+        }
+        # The exact period end arrives with customer.subscription.created/updated, so no
+        # Subscription.retrieve round-trip here. Write a provisional 30-day expiry unless
+        # that event already landed for this subscription.
+        if not subscription_id or user_data.get('stripeSubscriptionId') != subscription_id:
+            premium_update['premiumExpiresAt'] = datetime.now() + timedelta(days=30)
+        # Upgrade, waitlist removal, user counts and the event marker commit together
+        batch = _event_batch(db, event)
+        batch.set(_user_ref(db, user_id), premium_update, merge=True)
+        
+        # Update user counts
+        count_changes = {'premiumUsers': firestore.Increment(1)}
+        if was_on_waitlist:
+            # Remove from waitlist collection
+            batch.delete(db.collection('waitlist').document(user_id))
+            count_changes['waitlistUsers'] = firestore.Increment(-1)
+        else:
+            # Was a free user, decrement free count
+            count_changes['freeUsers'] = firestore.Increment(-1)
+        batch.set(db.collection('system').document('stats'), count_changes, merge=True)
+        batch.commit()
+        
+        forget_exhausted_credits(user_id)
+        logger.info(f"[Webhook] User {user_id[:8]}... upgraded to premium")
+        if was_on_waitlist:
+            logger.info(f"[Webhook] User removed from waitlist (bought premium)")
+        
+        # Release users from waitlist (each premium user allows 60 more free users).
+        # The event marker is already committed, so a redelivery would skip this - a failure
+        # here is logged rather than failing the webhook
+        try:
+            released = release_users_from_waitlist(FREE_TO_PREMIUM_RATIO)
+            if released > 0:
+                logger.info(f"[Webhook] Released {released} users from waitlist")
+        except Exception as e:
+            logger.error(f"[Webhook] Waitlist release after checkout failed: {type(e).__name__}: {e}")
+    
+    elif event_type in ('customer.subscription.created', 'customer.subscription.updated'):
+        subscription = event['data']['object']
+        metadata = subscription.get('metadata', {}) or {}
+        user_id = metadata.get('firebaseUserId')
+        
+        status = subscription.get('status')
+        if user_id and status in ('canceled', 'incomplete_expired'):
+            # A dead subscription's late update must not write its id back after .deleted
+            logger.info(f"[Webhook] Ignoring {event_type} for {status} subscription of user {user_id[:8]}...")
+            return
+        
+        if user_id:
+            # Stripe doesn't guarantee delivery order; drop events older than the last one applied.
+            # `created` only has one-second resolution, so on a tie a deletion always wins
+            user_data = (_user_ref(db, user_id).get().to_dict() or {})
+            last_event_at = user_data.get('stripeSubscriptionEventAt')
+            if last_event_at is not None and (
+                event['created'] < last_event_at
+                or (event['created'] == last_event_at
+                    and user_data.get('stripeSubscriptionEventType') == 'customer.subscription.deleted')
+            ):
+                logger.info(f"[Webhook] Ignoring out-of-order {event_type} for user {user_id[:8]}...")
+                return
+            
+            cancel_at_period_end = subscription.get('cancel_at_period_end', False)
+            period_end_timestamp = subscription.get('current_period_end')
+            period_end = datetime.fromtimestamp(period_end_timestamp) if period_end_timestamp else datetime.now() + timedelta(days=30)
+            
+            update_data = {
+                'premiumExpiresAt': period_end,
+                'stripeSubscriptionId': subscription.get('id'),
+                'stripeSubscriptionEventAt': event['created'],
+                'stripeSubscriptionEventType': event_type,
+            }
+            
+            if cancel_at_period_end:
+                update_data['subscriptionStatus'] = 'cancelling'
+                logger.info(f"[Webhook] User {user_id[:8]}... subscription cancelling at period end")
+            elif status == 'active':
+                update_data['subscriptionStatus'] = 'active'
+                update_data['isPremium'] = True
+                logger.info(f"[Webhook] User {user_id[:8]}... subscription renewed/active")
+            
+            batch = _event_batch(db, event)
+            batch.set(_user_ref(db, user_id), update_data, merge=True)
+            batch.commit()
+    
+    elif event_type == 'customer.subscription.deleted':
+        subscription = event['data']['object']
+        metadata = subscription.get('metadata', {}) or {}
+        user_id = metadata.get('firebaseUserId')
+        
+        if user_id:
+            # Subscription ended - remove premium and update counts (-1 premium, +1 free) in one batch
+            batch = _event_batch(db, event)
+            batch.set(_user_ref(db, user_id), {
+                'isPremium': False,
+                'subscriptionStatus': 'cancelled',
+                'stripeSubscriptionId': None,
+                'stripeSubscriptionEventAt': event['created'],
+                'stripeSubscriptionEventType': event_type,
+                'registeredAsFree': True,  # They become a free user again
+            }, merge=True)
+            batch.set(db.collection('system').document('stats'), {
+                'premiumUsers': firestore.Increment(-1),
+                'freeUsers': firestore.Increment(1),
+            }, merge=True)
+            batch.commit()
+            logger.info(f"[Webhook] User {user_id[:8]}... subscription cancelled")
+    
+    elif event_type == 'invoice.paid':
+        # Handles subscription renewals - fires when monthly payment succeeds
+        invoice = event['data']['object']
+        subscription_id = invoice.get('subscription')
+        billing_reason = invoice.get('billing_reason')  # 'subscription_cycle' for renewals
+        
+        logger.debug("[Webhook] invoice.paid - billing_reason: %s", billing_reason)
+        
+        if subscription_id:
+            # Get subscription to find user and period end (errors propagate so Stripe redelivers)
+            subscription = stripe.Subscription.retrieve(subscription_id)
+            sub_data = dict(subscription)
+            metadata = sub_data.get('metadata', {}) or {}
+            user_id = metadata.get('firebaseUserId')
+            
+            if user_id:
+                period_end_timestamp = sub_data.get('current_period_end')
+                period_end = datetime.fromtimestamp(period_end_timestamp) if period_end_timestamp else datetime.now() + timedelta(days=30)
+                
+                # Renew premium: extend expiration and reset credits
+                batch = _event_batch(db, event)
+                batch.set(_user_ref(db, user_id), {
+                    'isPremium': True,
+                    'premiumExpiresAt': period_end,
+                    'subscriptionStatus': 'active',
+                    'credits': 200,  # Reset to premium daily limit on renewal
+                }, merge=True)
+                batch.commit()
+                forget_exhausted_credits(user_id)
+                logger.info(f"[Webhook] User {user_id[:8]}... subscription renewed")
+            else:
+                logger.warning("[Webhook] invoice.paid - No firebaseUserId in subscription metadata")
+    
+    elif event_type == 'invoice.payment_failed':
+        invoice = event['data']['object']
+        subscription_id = invoice.get('subscription')
+        
+        if subscription_id:
+            # Get user ID from subscription metadata (errors propagate so Stripe redelivers)
+            subscription = stripe.Subscription.retrieve(subscription_id)
+            sub_data = dict(subscription)
+            metadata = sub_data.get('metadata', {}) or {}
+            user_id = metadata.get('firebaseUserId')
+            
+            if user_id:
+                batch = _event_batch(db, event)
+                batch.set(_user_ref(db, user_id), {
+                    'subscriptionStatus': 'payment_failed',
+                }, merge=True)
+                batch.commit()
+                logger.warning(f"[Webhook] User {user_id[:8]}... payment failed")
+            else:
+                logger.warning("[Webhook] invoice.payment_failed - No firebaseUserId in metadata")
+
+
 @app.route('/api/stripe-webhook', methods=['POST'])
 def stripe_webhook():
     """Handle Stripe webhook events."""
-    payload = request.get_data(as_text=True)
+    # Raw bytes: the signature is an HMAC over the exact body, no need to decode it first
+    payload = request.get_data()
     sig_header = request.headers.get('Stripe-Signature')
     
     # Get Stripe config
@@ -1490,182 +2398,19 @@ def stripe_webhook():
     event_type = event['type']
     logger.info(f"Processing Stripe webhook: {event_type}")
     
+    # Answer 200 only once the side effects are committed; on failure Stripe redelivers
+    # with its own backoff, and the event marker makes the redelivery a no-op if the
+    # failed attempt actually landed
     try:
-        if event_type == 'checkout.session.completed':
-            session = event['data']['object']
-            
-            user_id = session.get('metadata', {}).get('firebaseUserId')
-            subscription_id = session.get('subscription')
-            customer_id = session.get('customer')
-            
-            if not user_id:
-                logger.error("[Webhook] No firebaseUserId in checkout session metadata")
-                return Response(json.dumps({"error": "No user ID in metadata"}), status=400, mimetype='application/json')
-            
-            # Log only truncated user ID for privacy
-            logger.info(f"[Webhook] Processing checkout for user {user_id[:8]}...")
-            
-            if subscription_id:
-                # Get subscription details for the period end
-                try:
-                    subscription = stripe.Subscription.retrieve(subscription_id)
-                    # Convert to dict for reliable access (required in Stripe SDK v7+)
-                    sub_data = dict(subscription)
-                    period_end_timestamp = sub_data.get('current_period_end')
-                    if period_end_timestamp:
-                        period_end = datetime.fromtimestamp(period_end_timestamp)
-                    else:
-                        period_end = datetime.now() + timedelta(days=30)
-                except Exception as sub_error:
-                    logger.warning(f"[Webhook] Error retrieving subscription, using 30 days: {sub_error}")
-                    period_end = datetime.now() + timedelta(days=30)
-            else:
-                # No subscription yet (might be a one-time payment or subscription pending)
-                period_end = datetime.now() + timedelta(days=30)
-            
-            # Check if user was on waitlist (buying premium to skip)
-            user_doc = db.collection('users').document(user_id).get()
-            was_on_waitlist = False
-            if user_doc.exists:
-                user_data = user_doc.to_dict()
-                was_on_waitlist = user_data.get('onWaitlist', False)
-            
-            # Update user to premium
-            db.collection('users').document(user_id).set({
-                'isPremium': True,
-                'premiumExpiresAt': period_end,
-                'stripeCustomerId': customer_id,
-                'stripeSubscriptionId': subscription_id,
-                'subscriptionStatus': 'active',
-                'credits': 200,  # Give them premium credits immediately
-                'onWaitlist': False,  # Remove from waitlist if they were on it
-                'registeredAsFree': False,  # No longer a free user
-            }, merge=True)
-            logger.info(f"[Webhook] User {user_id[:8]}... upgraded to premium")
-            
-            # Update user counts
-            if was_on_waitlist:
-                # Remove from waitlist collection
-                db.collection('waitlist').document(user_id).delete()
-                increment_user_count('waitlistUsers', -1)
-                logger.info(f"[Webhook] User removed from waitlist (bought premium)")
-            else:
-                # Was a free user, decrement free count
-                increment_user_count('freeUsers', -1)
-            
-            # Increment premium count
-            increment_user_count('premiumUsers', 1)
-            
-            # Release users from waitlist (each premium user allows 60 more free users)
-            released = release_users_from_waitlist(FREE_TO_PREMIUM_RATIO)
-            if released > 0:
-                logger.info(f"[Webhook] Released {released} users from waitlist")
-        
-        elif event_type == 'customer.subscription.updated':
-            subscription = event['data']['object']
-            metadata = subscription.get('metadata', {}) or {}
-            user_id = metadata.get('firebaseUserId')
-            
-            if user_id:
-                cancel_at_period_end = subscription.get('cancel_at_period_end', False)
-                status = subscription.get('status')
-                period_end_timestamp = subscription.get('current_period_end')
-                period_end = datetime.fromtimestamp(period_end_timestamp) if period_end_timestamp else datetime.now() + timedelta(days=30)
-                
-                update_data = {
-                    'premiumExpiresAt': period_end,
-                }
-                
-                if cancel_at_period_end:
-                    update_data['subscriptionStatus'] = 'cancelling'
-                    logger.info(f"[Webhook] User {user_id[:8]}... subscription cancelling at period end")
-                elif status == 'active':
-                    update_data['subscriptionStatus'] = 'active'
-                    update_data['isPremium'] = True
-                    logger.info(f"[Webhook] User {user_id[:8]}... subscription renewed/active")
-                
-                db.collection('users').document(user_id).set(update_data, merge=True)
-        
-        elif event_type == 'customer.subscription.deleted':
-            subscription = event['data']['object']
-            metadata = subscription.get('metadata', {}) or {}
-            user_id = metadata.get('firebaseUserId')
-            
-            if user_id:
-                # Subscription ended - remove premium
-                db.collection('users').document(user_id).set({
-                    'isPremium': False,
-                    'subscriptionStatus': 'cancelled',
-                    'stripeSubscriptionId': None,
-                    'registeredAsFree': True,  # They become a free user again
-                }, merge=True)
-                logger.info(f"[Webhook] User {user_id[:8]}... subscription cancelled")
-                
-                # Update counts: -1 premium, +1 free
-                increment_user_count('premiumUsers', -1)
-                increment_user_count('freeUsers', 1)
-        
-        elif event_type == 'invoice.paid':
-            # Handles subscription renewals - fires when monthly payment succeeds
-            invoice = event['data']['object']
-            subscription_id = invoice.get('subscription')
-            billing_reason = invoice.get('billing_reason')  # 'subscription_cycle' for renewals
-            
-            logger.debug(f"[Webhook] invoice.paid - billing_reason: {billing_reason}")
-            
-            if subscription_id:
-                # Get subscription to find user and period end
-                try:
-                    subscription = stripe.Subscription.retrieve(subscription_id)
-                    sub_data = dict(subscription)
-                    metadata = sub_data.get('metadata', {}) or {}
-                    user_id = metadata.get('firebaseUserId')
-                    
-                    if user_id:
-                        period_end_timestamp = sub_data.get('current_period_end')
-                        period_end = datetime.fromtimestamp(period_end_timestamp) if period_end_timestamp else datetime.now() + timedelta(days=30)
-                        
-                        # Renew premium: extend expiration and reset credits
-                        db.collection('users').document(user_id).set({
-                            'isPremium': True,
-                            'premiumExpiresAt': period_end,
-                            'subscriptionStatus': 'active',
-                            'credits': 200,  # Reset to premium daily limit on renewal
-                        }, merge=True)
-                        logger.info(f"[Webhook] User {user_id[:8]}... subscription renewed")
-                    else:
-                        logger.warning("[Webhook] invoice.paid - No firebaseUserId in subscription metadata")
-                except Exception as sub_error:
-                    logger.error(f"[Webhook] invoice.paid - Error retrieving subscription: {sub_error}")
-        
-        elif event_type == 'invoice.payment_failed':
-            invoice = event['data']['object']
-            subscription_id = invoice.get('subscription')
-            
-            if subscription_id:
-                # Get user ID from subscription metadata
-                try:
-                    subscription = stripe.Subscription.retrieve(subscription_id)
-                    sub_data = dict(subscription)
-                    metadata = sub_data.get('metadata', {}) or {}
-                    user_id = metadata.get('firebaseUserId')
-                    
-                    if user_id:
-                        db.collection('users').document(user_id).set({
-                            'subscriptionStatus': 'payment_failed',
-                        }, merge=True)
-                        logger.warning(f"[Webhook] User {user_id[:8]}... payment failed")
-                    else:
-                        logger.warning("[Webhook] invoice.payment_failed - No firebaseUserId in metadata")
-                except Exception as sub_error:
-                    logger.error(f"[Webhook] invoice.payment_failed - Error: {sub_error}")
-        
-        return Response(json.dumps({"received": True}), status=200, mimetype='application/json')
-        
+        _handle_stripe_event(event, db)
+    except gcp_exceptions.AlreadyExists:
+        logger.info(f"[Webhook] {event_type} ({event['id']}) already processed, skipping")
     except Exception as e:
-        logger.error(f"[Webhook] Error processing webhook: {type(e).__name__}: {e}")
-        logger.debug(traceback.format_exc())
-        return Response(json.dumps({"error": "Webhook processing failed"}), status=500, mimetype='application/json')
+        logger.error(f"[Webhook] Error processing {event_type} ({event['id']}): {type(e).__name__}: {e}")
+        logger.debug("[Webhook] Processing traceback", exc_info=True)
+        return Response(status=500)
+    
+    return Response(orjson.dumps({"received": True}), status=200, mimetype='application/json')
 
 
 @app.route('/api/cancel-subscription', methods=['POST'])
@@ -1681,7 +2426,7 @@ def cancel_subscription():
     
     if not stripe.api_key:
         return Response(
-            json.dumps({"error": "Stripe not configured"}),
+            orjson.dumps({"error": "Stripe not configured"}),
             status=500,
             mimetype='application/json'
         )
@@ -1690,16 +2435,16 @@ def cancel_subscription():
         db = get_firestore_db()
         if not db:
             return Response(
-                json.dumps({"error": "Database not available"}),
+                orjson.dumps({"error": "Database not available"}),
                 status=500,
                 mimetype='application/json'
             )
         
         # Get user's subscription ID
-        user_doc = db.collection('users').document(user_id).get()
+        user_doc = _user_ref(db, user_id).get()
         if not user_doc.exists:
             return Response(
-                json.dumps({"error": "User not found"}),
+                orjson.dumps({"error": "User not found"}),
                 status=404,
                 mimetype='application/json'
             )
@@ -1709,7 +2454,7 @@ def cancel_subscription():
         
         if not subscription_id:
             return Response(
-                json.dumps({"error": "No active subscription found"}),
+                orjson.dumps({"error": "No active subscription found"}),
                 status=400,
                 mimetype='application/json'
             )
@@ -1725,13 +2470,13 @@ def cancel_subscription():
         period_end_timestamp = sub_data.get('current_period_end')
         period_end = datetime.fromtimestamp(period_end_timestamp) if period_end_timestamp else datetime.now() + timedelta(days=30)
         
-        db.collection('users').document(user_id).set({
+        _user_ref(db, user_id).set({
             'subscriptionStatus': 'cancelling',
             'premiumExpiresAt': period_end,
         }, merge=True)
         
         return Response(
-            json.dumps({
+            orjson.dumps({
                 "success": True,
                 "message": f"Subscription will cancel at end of billing period",
                 "expiresAt": period_end.isoformat()
@@ -1743,14 +2488,14 @@ def cancel_subscription():
     except stripe.error.StripeError as e:
         logger.error(f"Stripe error cancelling subscription: {type(e).__name__}")
         return Response(
-            json.dumps({"error": "Failed to cancel subscription"}),
+            orjson.dumps({"error": "Failed to cancel subscription"}),
             status=400,
             mimetype='application/json'
         )
     except Exception as e:
         logger.error(f"Error cancelling subscription: {e}")
         return Response(
-            json.dumps({"error": "Failed to cancel subscription"}),
+            orjson.dumps({"error": "Failed to cancel subscription"}),
             status=500,
             mimetype='application/json'
         )
@@ -1862,7 +2607,7 @@ def release_users_from_waitlist(count: int):
             user_data = doc.to_dict()
             
             # Update user document - remove from waitlist
-            db.collection('users').document(user_id).set({
+            _user_ref(db, user_id).set({
                 'onWaitlist': False,
                 'waitlistReleasedAt': datetime.now()
             }, merge=True)
@@ -1900,7 +2645,7 @@ def check_waitlist():
         # If database unavailable, allow user (fail open)
         logger.warning(f"[Waitlist] Database unavailable, allowing user {user_id[:8]}...")
         return Response(
-            json.dumps({
+            orjson.dumps({
                 "shouldWaitlist": False,
                 "reason": "Database unavailable"
             }),
@@ -1912,7 +2657,7 @@ def check_waitlist():
         stats = get_waitlist_stats()
         if not stats:
             return Response(
-                json.dumps({"shouldWaitlist": False, "reason": "Could not get stats"}),
+                orjson.dumps({"shouldWaitlist": False, "reason": "Could not get stats"}),
                 status=200,
                 mimetype='application/json'
             )
@@ -1925,7 +2670,7 @@ def check_waitlist():
             has_capacity = True
         
         return Response(
-            json.dumps({
+            orjson.dumps({
                 "shouldWaitlist": not has_capacity,
                 "capacity": stats['capacity'],
                 "freeUsers": stats['freeUsers'],
@@ -1939,7 +2684,7 @@ def check_waitlist():
     except Exception as e:
         logger.error(f"Error checking waitlist: {e}")
         return Response(
-            json.dumps({"shouldWaitlist": False, "error": "Failed to check waitlist"}),
+            orjson.dumps({"shouldWaitlist": False, "error": "Failed to check waitlist"}),
             status=200,
             mimetype='application/json'
         )
@@ -1957,7 +2702,7 @@ def join_waitlist():
     db = get_firestore_db()
     if not db:
         return Response(
-            json.dumps({"error": "Database unavailable"}),
+            orjson.dumps({"error": "Database unavailable"}),
             status=500,
             mimetype='application/json'
         )
@@ -1969,7 +2714,7 @@ def join_waitlist():
             # Get their position
             position = get_waitlist_position(user_id)
             return Response(
-                json.dumps({
+                orjson.dumps({
                     "success": True,
                     "alreadyOnWaitlist": True,
                     "position": position
@@ -1986,7 +2731,7 @@ def join_waitlist():
         })
         
         # Update user document
-        db.collection('users').document(user_id).set({
+        _user_ref(db, user_id).set({
             'onWaitlist': True,
             'waitlistJoinedAt': datetime.now()
         }, merge=True)
@@ -1998,7 +2743,7 @@ def join_waitlist():
         position = get_waitlist_position(user_id)
         
         return Response(
-            json.dumps({
+            orjson.dumps({
                 "success": True,
                 "position": position
             }),
@@ -2008,7 +2753,7 @@ def join_waitlist():
     except Exception as e:
         logger.error(f"Error joining waitlist: {e}")
         return Response(
-            json.dumps({"error": "Failed to join waitlist"}),
+            orjson.dumps({"error": "Failed to join waitlist"}),
             status=500,
             mimetype='application/json'
         )
@@ -2058,17 +2803,17 @@ def waitlist_status():
     db = get_firestore_db()
     if not db:
         return Response(
-            json.dumps({"error": "Database unavailable"}),
+            orjson.dumps({"error": "Database unavailable"}),
             status=500,
             mimetype='application/json'
         )
     
     try:
         # Check if user is on waitlist
-        user_doc = db.collection('users').document(user_id).get()
+        user_doc = _user_ref(db, user_id).get()
         if not user_doc.exists:
             return Response(
-                json.dumps({
+                orjson.dumps({
                     "onWaitlist": False,
                     "reason": "User not found"
                 }),
@@ -2081,7 +2826,7 @@ def waitlist_status():
         
         if not on_waitlist:
             return Response(
-                json.dumps({
+                orjson.dumps({
                     "onWaitlist": False,
                     "isPremium": user_data.get('isPremium', False)
                 }),
@@ -2094,7 +2839,7 @@ def waitlist_status():
         stats = get_waitlist_stats()
         
         return Response(
-            json.dumps({
+            orjson.dumps({
                 "onWaitlist": True,
                 "position": position,
                 "totalWaiting": stats['waitlistUsers'] if stats else 0,
@@ -2106,7 +2851,7 @@ def waitlist_status():
     except Exception as e:
         logger.error(f"Error getting waitlist status: {e}")
         return Response(
-            json.dumps({"error": "Failed to get waitlist status"}),
+            orjson.dumps({"error": "Failed to get waitlist status"}),
             status=500,
             mimetype='application/json'
         )
@@ -2123,25 +2868,25 @@ def register_free_user():
     db = get_firestore_db()
     if not db:
         return Response(
-            json.dumps({"error": "Database unavailable"}),
+            orjson.dumps({"error": "Database unavailable"}),
             status=500,
             mimetype='application/json'
         )
     
     try:
         # Check if user already registered
-        user_doc = db.collection('users').document(user_id).get()
+        user_doc = _user_ref(db, user_id).get()
         if user_doc.exists:
             user_data = user_doc.to_dict()
             if user_data.get('registeredAsFree'):
                 return Response(
-                    json.dumps({"success": True, "alreadyRegistered": True}),
+                    orjson.dumps({"success": True, "alreadyRegistered": True}),
                     status=200,
                     mimetype='application/json'
                 )
         
         # Mark user as registered free user
-        db.collection('users').document(user_id).set({
+        _user_ref(db, user_id).set({
             'registeredAsFree': True,
             'registeredAt': datetime.now()
         }, merge=True)
@@ -2150,23 +2895,33 @@ def register_free_user():
         increment_user_count('freeUsers', 1)
         
         return Response(
-            json.dumps({"success": True}),
+            orjson.dumps({"success": True}),
             status=200,
             mimetype='application/json'
         )
     except Exception as e:
         logger.error(f"Error registering free user: {e}")
         return Response(
-            json.dumps({"error": "Failed to register user"}),
+            orjson.dumps({"error": "Failed to register user"}),
             status=500,
             mimetype='application/json'
         )
 
 
+# Pre-encoded health body; the endpoint is polled constantly and never changes
+_HEALTH_RESPONSE_BODY = orjson.dumps({"status": "ok"})
+
+
 @app.route('/api/health', methods=['GET'])
 def health():
     """Health check endpoint."""
-    return {"status": "ok"}
+    # A fresh Response per call - after_request hooks add headers to it
+    return Response(
+        _HEALTH_RESPONSE_BODY,
+        status=200,
+        mimetype='application/json',
+        headers={'Cache-Control': 'no-store'}
+    )
 
 
 if __name__ == '__main__':
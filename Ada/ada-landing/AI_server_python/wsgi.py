@@ -0,0 +1,25 @@
+"""Gunicorn entry point for gevent workers.
+
+Monkey-patching must happen before main (and the libraries it imports)
+create any sockets, locks or threads, so it lives here rather than in main.py.
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+# Firestore talks over gRPC, which has its own I/O loop; let it cooperate with gevent
+try:
+    from grpc.experimental import gevent as grpc_gevent
+    grpc_gevent.init_gevent()
+except ImportError:
+    pass
+
+import gc  # noqa: E402
+
+from main import app  # noqa: E402
+
+# Everything allocated at import time (modules, prompts, SDK clients) lives for the whole
+# worker; move it out of the collector's view so full collections during streaming stay short
+gc.freeze()
+
+__all__ = ["app"]